@@ -3,134 +3,269 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 '''
 
-import boto3
 import botocore
 import os
+import time
+from apiMetrics import instrumented
+from awsClients import CredentialBroker, clientWithCredentials, lazyClient
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from ddbReader import getItems
+from eventLog import DEBUG, WARNING, ERROR, event_log
+from migrationStatus import INVITED, LEFT, ACCEPTED, MOVED, accountsInStatus, claimAccount, hasReached, isClaimed, releaseAccount, setStatus, statusOf
+from orgSnapshot import readSnapshot
+from orgThrottle import AdaptiveLimiter
 
 ACCOUNT_TABLE_NAME=os.environ['ACCOUNT_TABLE_NAME']
 OU_TABLE_NAME=os.environ['OU_TABLE_NAME']
 ACCEPT_ROLE_NAME=os.environ['ACCEPT_ROLE_NAME']
+OLD_ORG_MA=os.environ['OLD_ORG_MA']
+ACCEPT_WORKERS=int(os.environ.get('ACCEPT_WORKERS', '8'))
+# Seconds an invocation holds the claim on an account it migrates, at least
+# the timeout of the function
+ACCEPT_LEASE_SECONDS=int(os.environ.get('ACCEPT_LEASE_SECONDS', '900'))
+# Seconds left to the function timeout at which no more accounts are
+# started, enough for the accounts in flight to finish
+ACCEPT_TIME_MARGIN=int(os.environ.get('ACCEPT_TIME_MARGIN', '60'))
+# Returned by migrateClaimed for accounts migrated by another invocation
+IN_PROGRESS='in_progress'
 
-def aws_session(role_arn=None, session_name='ma_session'):
+# Clients are shared by the worker threads
+org_limiter=AdaptiveLimiter()
+ddb_client=lazyClient('dynamodb', max_pool_connections=ACCEPT_WORKERS)
+s3_client=lazyClient('s3')
+new_org_client=lazyClient('organizations', max_pool_connections=ACCEPT_WORKERS, limiter=org_limiter)
+# Credentials for the accept role of the member accounts
+member_credentials=CredentialBroker(ACCEPT_ROLE_NAME, 'member_session')
+
+ACCOUNT_ATTRIBUTES=[
+    "AccountId",
+    "HandshakeId",
+    "AccountParentId",
+    "AccountParentName",
+    "MigrationStatus",
+    "ClaimedUntil"
+]
+
+def loadNewOuIds(accounts):
+    """
+    Maps the id of every old OU the accounts are in to the id of its copy
+    in the new organization. The ids come from the snapshot written by
+    replicateOuStructure, the OUs missing there are point reads of the OU
+    table keyed by the old OU id
+    """
+    parent_ids={account['AccountParentId']['S'] for account in accounts}
+    new_ou_ids={}
+    tree=readSnapshot(s3_client)
+    if tree is not None:
+        for parent_id in parent_ids:
+            if parent_id in tree.ou_index and tree.ou(parent_id).new_id:
+                new_ou_ids[parent_id]=tree.ou(parent_id).new_id
+        parent_ids -= set(new_ou_ids)
+    for ou in getItems(ddb_client, OU_TABLE_NAME, 'OuId', parent_ids, ['OuId', 'NewOuId']):
+        if 'NewOuId' in ou:
+            new_ou_ids[ou['OuId']['S']]=ou['NewOuId']['S']
+    return new_ou_ids
+
+def recordStep(account_id, status):
+    """
+    Records a completed step. Returns None if it was recorded, False if
+    another run already recorded it and the account should not be processed
+    any further by this run, and the failed step 'record_status' if the
+    status could not be written, so the account is reported
+    """
+    try:
+        if not setStatus(ddb_client, ACCOUNT_TABLE_NAME, account_id, status):
+            return False
+    except botocore.exceptions.ClientError as error:
+        event_log.event('accept', 'recordStatusFailed', ERROR, Account=account_id, Status=status, Error=str(error))
+        return 'record_status'
+    event_log.account(account_id, Status=status)
+    return None
+
+def migrateAccount(account_id, handshake_id, new_ou_id, new_root_id, status):
     """
-    If role_arn is given assumes a role and returns boto3 session
-    otherwise return a regular session with the current IAM user/role
+    Moves one member account: leaves the old organization, accepts the
+    invitation and moves the account to its OU in the new organization.
+    Steps already recorded in status are skipped and every completed step
+    is recorded. Stops at the first failing step and returns its name,
+    None otherwise
     """
-    if role_arn:
-        client=boto3.client('sts')
+    if not hasReached(status, ACCEPTED):
         try:
-            response=client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)
-            session=boto3.Session(
-                aws_access_key_id=response['Credentials']['AccessKeyId'],
-                aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-                aws_session_token=response['Credentials']['SessionToken'])
-            return session
+            credentials=member_credentials.get(account_id)
         except botocore.exceptions.ClientError as error:
-            print ('Caught exception creating a session')
-            print(error)
-    else:
-        return boto3.Session()
+            event_log.event('accept', 'assumeRoleFailed', ERROR, Account=account_id, Error=str(error))
+            return 'assume_role'
+        member_org_client=clientWithCredentials('organizations', credentials, limiter=org_limiter)
 
-ddb_client=boto3.client('dynamodb')
-new_org_client=boto3.client('organizations')
+    if not hasReached(status, LEFT):
+        try:
+            event_log.event('accept', 'leaveOrganization', DEBUG, sampled=True, Account=account_id)
+            member_org_client.leave_organization()
+        except botocore.exceptions.ClientError as error:
+            event_log.event('accept', 'leaveOrganizationFailed', ERROR, Account=account_id, Error=str(error))
+            return 'leave_organization'
+        failed=recordStep(account_id, LEFT)
+        if failed is not None:
+            return failed or None
 
-def acceptInvitation(new_root_id):
-    try:
-        response=ddb_client.scan(
-            TableName=ACCOUNT_TABLE_NAME,
-            AttributesToGet=['AccountId']
+    if not hasReached(status, ACCEPTED):
+        try:
+            event_log.event('accept', 'acceptHandshake', DEBUG, sampled=True, Account=account_id, Handshake=handshake_id)
+            member_org_client.accept_handshake(
+                HandshakeId = handshake_id
             )
+        except botocore.exceptions.ClientError as error:
+            event_log.event('accept', 'acceptHandshakeFailed', ERROR, Account=account_id, Handshake=handshake_id, Error=str(error))
+            return 'accept_handshake'
+        failed=recordStep(account_id, ACCEPTED)
+        if failed is not None:
+            return failed or None
+
+    try:
+        event_log.event('accept', 'moveAccount', DEBUG, sampled=True, Account=account_id, Ou=new_ou_id)
+        new_org_client.move_account(
+            AccountId=account_id,
+            SourceParentId=new_root_id,
+            DestinationParentId=new_ou_id
+        )
+        event_log.account(account_id, NewOu=new_ou_id)
     except botocore.exceptions.ClientError as error:
-        print ('Caught exception scanning DynamoDB table')
-        print(error)
+        event_log.event('accept', 'moveAccountFailed', ERROR, Account=account_id, Ou=new_ou_id, Error=str(error))
+        return 'move_account'
+    return recordStep(account_id, MOVED) or None
 
-    for account in response['Items']:
-        account_id=account['AccountId']['S']
+def migrateClaimed(account_id, *args):
+    """
+    Migrates the account with migrateAccount while holding the claim on it,
+    returns IN_PROGRESS if another invocation holds the claim
+    """
+    if not claimAccount(ddb_client, ACCOUNT_TABLE_NAME, account_id, ACCEPT_LEASE_SECONDS):
+        return IN_PROGRESS
+    try:
+        return migrateAccount(account_id, *args)
+    finally:
         try:
-            account_info=ddb_client.get_item(
-                TableName=ACCOUNT_TABLE_NAME,
-                Key={
-                    'AccountId': {'S': account_id}
-                },
-                AttributesToGet=[
-                    "AccountParentType",
-                    "HandshakeId",
-                    "AccountParentName"
-                ]
-            )
-            account_parent_type=account_info['Item']['AccountParentType']['S']
-            account_parent_name=account_info['Item']['AccountParentName']['S']
-            if account_parent_type != "ROOT":    
-                handshake_id=account_info['Item']['HandshakeId']['S']
+            releaseAccount(ddb_client, ACCOUNT_TABLE_NAME, account_id)
         except botocore.exceptions.ClientError as error:
-            print ('Caught exception getting item')
-            print(error)
-        
-        #print(account_parent_type)
-        #print('account parent type is ' + account_parent_type)
-        if account_parent_type == "ROOT":
-            print('Skipping Master Account for now.., will work on it later')
+            event_log.event('accept', 'releaseAccountFailed', ERROR, Account=account_id, Error=str(error))
+
+def streamedAccounts(records):
+    """
+    Returns the ids of the accounts that a batch of records of the account
+    table stream shows becoming INVITED
+    """
+    account_ids=[]
+    for record in records:
+        new_image=record.get('dynamodb', {}).get('NewImage', {})
+        old_image=record.get('dynamodb', {}).get('OldImage', {})
+        if statusOf(new_image) == INVITED and (not old_image or statusOf(old_image) != INVITED):
+            account_ids.append(new_image['AccountId']['S'])
+    return account_ids
+
+def acceptInvitation(new_root_id, account_ids=None, deadline=None):
+    """
+    Migrates the member accounts on a pool of ACCEPT_WORKERS threads, either
+    the given account_ids or every invited account that was not moved yet,
+    read from the status index. A failure only
+    stops the account it happened in, the accounts that could not be
+    migrated are returned with the step that failed, together with the
+    number of accounts another invocation is migrating. Once the deadline
+    has passed no more accounts are started, they are counted as in
+    progress too, so the state machine invokes the function again
+    """
+    failed={}
+    in_progress=0
+    try:
+        if account_ids is None:
+            accounts=list(accountsInStatus(ddb_client, ACCOUNT_TABLE_NAME, [INVITED, LEFT, ACCEPTED]))
         else:
-            ACCEPT_ROLE_ARN="arn:aws:iam::"+account_id+":role/"+ACCEPT_ROLE_NAME
-            try:
-                ou_info=ddb_client.get_item(
-                    TableName=OU_TABLE_NAME,
-                    Key={
-                        'OuName': {'S': account_parent_name}
-                    },
-                    AttributesToGet=[
-                        "NewOuId"
-                    ]
-                )
-                new_ou_id=ou_info['Item']['NewOuId']['S']
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception getting item')
-                print(error)
-            
-            try:
-                member_session_assumed = aws_session(role_arn=ACCEPT_ROLE_ARN, session_name='member_session')
-                member_org_client = member_session_assumed.client('organizations')
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception assuming role in member account')
-                print(error)
-
-            try:
-                print(account_id + ' is leaving old orginization')
-                leave_response = member_org_client.leave_organization()
-                print(leave_response)
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception leaving old organization')
-                print(error)
-
-            try:
-                print('Accepting inviation for ' + account_id)
-                accept_response = member_org_client.accept_handshake(
-                    HandshakeId = handshake_id
-                )
-                print(accept_response)
-                # update DDB Table with success for every account
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception accepting invitation')
-                print(error)
-
-            try:    
-                print('Moving ' + account_id + ' to the new Org under the OU ' + new_ou_id)
-                move_response = new_org_client.move_account(
-                    AccountId=account_id,
-                    SourceParentId=new_root_id,
-                    DestinationParentId=new_ou_id
-                )
-                print(move_response)
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception moving account to the correct OU in the new Org')
-                print(error)
+            accounts=getItems(ddb_client, ACCOUNT_TABLE_NAME, 'AccountId', account_ids, ACCOUNT_ATTRIBUTES)
+        new_ou_ids=loadNewOuIds(accounts)
+    except botocore.exceptions.ClientError as error:
+        print ('Caught exception reading DynamoDB table')
+        print(error)
+        return failed, in_progress
 
+    work=[]
+    now=time.time()
+    for account in accounts:
+        account_id=account['AccountId']['S']
+        account_parent_id=account['AccountParentId']['S']
+        account_parent_name=account['AccountParentName']['S']
+
+        if account_id == OLD_ORG_MA:
+            # The old management account is migrated by moveMaster, it may
+            # sit in an OU
+            pass
+        elif statusOf(account) == MOVED:
+            event_log.account(account_id, Status=MOVED, Skipped='already moved')
+        elif isClaimed(account, now):
+            event_log.account(account_id, Status=statusOf(account), Skipped='migrated by another invocation')
+            in_progress += 1
+        elif 'HandshakeId' not in account:
+            event_log.account(account_id, Status=statusOf(account), Skipped='no invitation was sent')
+            failed[account_id]='invite_account_to_organization'
+        elif account_parent_id not in new_ou_ids:
+            event_log.account(account_id, Status=statusOf(account), Skipped='the OU ' + account_parent_name + ' was not replicated')
+            failed[account_id]='create_organizational_unit'
+        else:
+            work.append((account_id, account['HandshakeId']['S'], new_ou_ids[account_parent_id], new_root_id, statusOf(account)))
+
+    # The member roles are assumed ahead of the workers that need them, so
+    # STS is not on the critical path of every account
+    member_credentials.prefetch([args[0] for args in work if not hasReached(args[4], ACCEPTED)])
+
+    # The accounts are submitted as workers free up, so the ones not started
+    # by the deadline are left for the next invocation
+    work.reverse()
+    with ThreadPoolExecutor(max_workers=ACCEPT_WORKERS) as executor:
+        futures={}
+        while work or futures:
+            while work and len(futures) < ACCEPT_WORKERS and (deadline is None or time.time() < deadline):
+                args=work.pop()
+                futures[executor.submit(migrateClaimed, *args)]=args[0]
+            if not futures:
+                break
+            done, pending=wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                account_id=futures.pop(future)
+                try:
+                    failed_step=future.result()
+                except Exception as error:
+                    event_log.event('accept', 'migrateAccountFailed', ERROR, Account=account_id, Error=str(error))
+                    failed_step='unexpected_error'
+                if failed_step == IN_PROGRESS:
+                    event_log.account(account_id, Skipped='migrated by another invocation')
+                    in_progress += 1
+                elif failed_step:
+                    event_log.account(account_id, FailedStep=failed_step)
+                    failed[account_id]=failed_step
+    if work:
+        event_log.event('accept', 'acceptStopped', WARNING, Remaining=len(work))
+        in_progress += len(work)
+    return failed, in_progress
+
+@instrumented
 def lambda_handler(event, context):
+    deadline=None
+    if context is not None:
+        deadline=time.time() + context.get_remaining_time_in_millis() / 1000 - ACCEPT_TIME_MARGIN
     try:
         new_root_id=new_org_client.list_roots()["Roots"][0]["Id"]
     except botocore.exceptions.ClientError as error:
         print ('Caught exception listing roots')
-        print(error)    
+        print(error)
+        raise
 
-    acceptInvitation(new_root_id)
-    
\ No newline at end of file
+    # The Map state of the state machine sends one batch of accounts per
+    # invocation, the account table stream the accounts that were invited
+    account_ids=event.get('AccountIds') if event else None
+    if event and 'Records' in event:
+        account_ids=streamedAccounts(event['Records'])
+        if not account_ids:
+            return {'FailedAccounts': {}, 'InProgress': 0}
+    failed, in_progress=acceptInvitation(new_root_id, account_ids, deadline)
+    if failed:
+        event_log.event('accept', 'accountsFailed', WARNING, Accounts=failed)
+    return {'FailedAccounts': failed, 'InProgress': in_progress}
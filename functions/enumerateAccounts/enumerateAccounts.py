@@ -0,0 +1,76 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+'''
+
+import botocore
+import json
+import os
+import time
+from apiMetrics import instrumented
+from awsClients import lazyClient
+from eventLog import event_log
+from migrationStatus import INVITED, LEFT, ACCEPTED, accountsInStatus, isClaimed
+
+ACCOUNT_TABLE_NAME=os.environ['ACCOUNT_TABLE_NAME']
+OLD_ORG_MA=os.environ['OLD_ORG_MA']
+BATCH_SIZE=int(os.environ.get('BATCH_SIZE', '10'))
+
+# The batches are written to the bucket and read by the Map state of the
+# state machine, so their size is not limited by the state data
+SNAPSHOT_BUCKET=os.environ.get('SNAPSHOT_BUCKET')
+BATCHES_KEY=os.environ.get('BATCHES_KEY', 'acceptBatches.json')
+
+ddb_client=lazyClient('dynamodb')
+s3_client=lazyClient('s3')
+
+def enumerateAccounts():
+    """
+    Returns the invited member accounts that still have to be migrated,
+    split into batches of BATCH_SIZE account ids, and the number of
+    accounts another invocation, e.g. one started by the account table
+    stream, is migrating. The old management account is left out, it is
+    migrated by moveMaster
+    """
+    batches=[]
+    account_ids=[]
+    in_progress=0
+    now=time.time()
+    try:
+        for account in accountsInStatus(ddb_client, ACCOUNT_TABLE_NAME, [INVITED, LEFT, ACCEPTED]):
+            if account['AccountId']['S'] == OLD_ORG_MA:
+                continue
+            if isClaimed(account, now):
+                in_progress += 1
+            else:
+                account_ids.append(account['AccountId']['S'])
+    except botocore.exceptions.ClientError as error:
+        print ('Caught exception querying DynamoDB table')
+        print(error)
+
+    account_ids.sort()
+    for start in range(0, len(account_ids), BATCH_SIZE):
+        batches.append({'AccountIds': account_ids[start:start + BATCH_SIZE]})
+    event_log.event('enumerate', 'accountsEnumerated', Accounts=len(account_ids), Batches=len(batches), InProgress=in_progress)
+    return batches, in_progress
+
+def writeBatches(batches):
+    """
+    Writes the batches as a JSON array to BATCHES_KEY in the snapshot bucket
+    """
+    s3_client.put_object(
+        Bucket=SNAPSHOT_BUCKET,
+        Key=BATCHES_KEY,
+        Body=json.dumps(batches, separators=(',', ':')).encode('utf-8'),
+        ContentType='application/json')
+
+@instrumented
+def lambda_handler(event, context):
+    batches, in_progress=enumerateAccounts()
+    try:
+        writeBatches(batches)
+    except botocore.exceptions.ClientError as error:
+        print ('Caught exception writing batches')
+        print(error)
+        raise
+    return {'Bucket': SNAPSHOT_BUCKET, 'Key': BATCHES_KEY, 'Batches': len(batches), 'InProgress': in_progress}
@@ -3,26 +3,118 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 '''
 
-import boto3
 import botocore
 import os
+import time
+from apiMetrics import instrumented
+from awsClients import lazyClient
+from eventLog import DEBUG, WARNING, ERROR, event_log
+from migrationStatus import PENDING, INVITED, accountsInStatus, setStatus
+from orgThrottle import AdaptiveLimiter
 
 ACCOUNT_TABLE_NAME=os.environ['ACCOUNT_TABLE_NAME']
 OLD_ORG_MA=os.environ['OLD_ORG_MA']
+# Invitations sent per invocation, the state machine invokes the function
+# again until every account is invited
+INVITE_WAVE_SIZE=int(os.environ.get('INVITE_WAVE_SIZE', '20'))
+# Invitations the new organization can send per INVITE_QUOTA_WINDOW seconds,
+# 20 per day unless the quota was raised
+INVITE_QUOTA=int(os.environ.get('INVITE_QUOTA', '20'))
+INVITE_QUOTA_WINDOW=int(os.environ.get('INVITE_QUOTA_WINDOW', '86400'))
+# Added to the wait for the quota, so the oldest invitation has surely expired
+INVITE_QUOTA_MARGIN=60
+# States of an invitation that can still be accepted
+OPEN_STATES=['REQUESTED', 'OPEN']
 
-ddb_client=boto3.client('dynamodb')
-new_org_client=boto3.client('organizations')
+ddb_client=lazyClient('dynamodb')
+new_org_client=lazyClient('organizations', limiter=AdaptiveLimiter())
+
+def recentInvitations(now):
+    """
+    Returns the times, oldest first, of the invitations the new organization
+    sent within the quota window, including the ones not sent by this
+    application, and the open invitations keyed by the invited account id.
+    Returns empty results if the handshakes can not be listed, the quota is
+    then only detected when an invitation is rejected
+    """
+    sent=[]
+    open_handshakes={}
+    try:
+        paginator=new_org_client.get_paginator('list_handshakes_for_organization')
+        for page in paginator.paginate(Filter={'ActionType': 'INVITE'}):
+            for handshake in page['Handshakes']:
+                requested=handshake['RequestedTimestamp'].timestamp()
+                if requested > now - INVITE_QUOTA_WINDOW:
+                    sent.append(requested)
+                if handshake.get('State') in OPEN_STATES:
+                    for party in handshake.get('Parties', []):
+                        if party['Type'] == 'ACCOUNT':
+                            open_handshakes[party['Id']]=(handshake['Id'], requested)
+    except botocore.exceptions.ClientError as error:
+        event_log.event('invite', 'listHandshakesFailed', ERROR, Error=str(error))
+    return sorted(sent), open_handshakes
+
+def recordInvitation(account_id, handshake_id, invited_at):
+    """
+    Records the invitation of the account, returns False if it could not be
+    written
+    """
+    try:
+        if setStatus(ddb_client, ACCOUNT_TABLE_NAME, account_id, INVITED, {
+            'HandshakeId': {'S': handshake_id},
+            'InvitedAt': {'N': str(int(invited_at))}
+        }):
+            event_log.account(account_id, Status=INVITED, Handshake=handshake_id)
+        return True
+    except botocore.exceptions.ClientError as error:
+        event_log.event('invite', 'recordInvitationFailed', ERROR, Account=account_id, Error=str(error))
+        return False
+
+def quotaWait(sent, now):
+    """
+    Seconds until the oldest invitation within the quota window expires and
+    the next one can be sent
+    """
+    if len(sent) < INVITE_QUOTA:
+        return 0
+    return max(0, int(sent[len(sent) - INVITE_QUOTA] + INVITE_QUOTA_WINDOW - now) + INVITE_QUOTA_MARGIN)
 
 def inviteAccounts():
+    """
+    Sends one wave of invitations, at most INVITE_WAVE_SIZE and no more than
+    the quota of the new organization has left. The accounts stay PENDING
+    until they are invited, so the next wave, in the same or a later
+    execution of the state machine, continues with them. An account that
+    already has an open invitation, e.g. because recording it failed, is
+    recorded as invited with that invitation. Returns the number of invited
+    and remaining accounts, the seconds to wait for the quota and the
+    accounts that could not be invited with the reason
+    """
+    now=time.time()
+    sent, open_handshakes=recentInvitations(now)
+    wave=max(0, min(INVITE_WAVE_SIZE, INVITE_QUOTA - len(sent)))
+    event_log.event('invite', 'inviteWave', Used=len(sent), Quota=INVITE_QUOTA, Wave=wave)
+
+    invited=0
+    remaining=0
+    failed={}
+    quota_exceeded=False
     try:
-        response=ddb_client.scan(
-            TableName=ACCOUNT_TABLE_NAME,
-            AttributesToGet=['AccountId']
-            )
-        for account in response['Items']:
+        for account in accountsInStatus(ddb_client, ACCOUNT_TABLE_NAME, [PENDING]):
             account_id=account['AccountId']['S']
-            if account_id != OLD_ORG_MA:
-                print('Sending inviation to ' + account_id)
+            if account_id == OLD_ORG_MA:
+                # The old management account is invited by moveMaster
+                pass
+            elif account_id in open_handshakes:
+                handshake_id, requested=open_handshakes[account_id]
+                if recordInvitation(account_id, handshake_id, requested):
+                    invited += 1
+                else:
+                    failed[account_id]='record_status'
+            elif quota_exceeded or invited >= wave:
+                remaining += 1
+            else:
+                event_log.event('invite', 'inviteAccount', DEBUG, sampled=True, Account=account_id)
                 try:
                     new_org_invite=new_org_client.invite_account_to_organization(
                         Target={
@@ -31,28 +123,47 @@ def inviteAccounts():
                         Notes='Invitaion to join the new Org-New'
                         )
                     handshake_id=new_org_invite['Handshake']['Id']
-                    print(handshake_id)
                 except botocore.exceptions.ClientError as error:
-                    print ('Caught exception inviting account')
-                    print(error)
+                    if error.response.get('Reason') == 'HANDSHAKE_RATE_LIMIT_EXCEEDED':
+                        event_log.event('invite', 'inviteQuotaExceeded', WARNING, Account=account_id)
+                        quota_exceeded=True
+                        remaining += 1
+                        continue
+                    if error.response['Error']['Code'] == 'DuplicateHandshakeException':
+                        # The account was invited before but the invitation
+                        # was not recorded, it is recorded now
+                        open_handshakes.update(recentInvitations(time.time())[1])
+                        if account_id in open_handshakes:
+                            handshake_id, requested=open_handshakes[account_id]
+                            if recordInvitation(account_id, handshake_id, requested):
+                                invited += 1
+                            else:
+                                failed[account_id]='record_status'
+                            continue
+                    event_log.event('invite', 'inviteFailed', ERROR, Account=account_id, Error=str(error))
+                    failed[account_id]=error.response['Error']['Code']
+                    continue
 
-                try:
-                    ddb_client.update_item(
-                        TableName=ACCOUNT_TABLE_NAME,
-                        Key={
-                            'AccountId': {'S': account_id}
-                        },
-                        UpdateExpression="SET HandshakeId = :NewHandshakeId",
-                        ExpressionAttributeValues={":NewHandshakeId": {"S": handshake_id}}
-                    )        
-                except botocore.exceptions.ClientError as error:
-                    print ('Caught exception updating item')
-                    print(error)
-            else:
-                print('Skipping inviation for old management account: ' + account_id)
+                invited += 1
+                sent.append(time.time())
+                if not recordInvitation(account_id, handshake_id, sent[-1]):
+                    failed[account_id]='record_status'
     except botocore.exceptions.ClientError as error:
-        print ('Caught exception scanning DynamoDB table')
+        print ('Caught exception querying DynamoDB table')
         print(error)
 
+    wait=0
+    if quota_exceeded and len(sent) < INVITE_QUOTA:
+        # The quota is used up although fewer invitations were counted, e.g.
+        # because the handshakes could not be listed
+        wait=INVITE_QUOTA_WINDOW
+    elif remaining:
+        wait=quotaWait(sent, time.time())
+    event_log.event('invite', 'invitesSent', Invited=invited, Remaining=remaining, WaitSeconds=wait, Failed=len(failed))
+    if failed:
+        event_log.event('invite', 'accountsFailed', WARNING, Accounts=failed)
+    return {'Invited': invited, 'Remaining': remaining, 'WaitSeconds': wait, 'FailedAccounts': failed}
+
+@instrumented
 def lambda_handler(event, context):
-    inviteAccounts()
\ No newline at end of file
+    return inviteAccounts()
@@ -3,9 +3,14 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 '''
 
-import boto3
 import os
 import botocore
+from apiMetrics import instrumented
+from awsClients import lazyClient
+from eventLog import ERROR, event_log
+from migrationStatus import PENDING, INVITED, ACCEPTED, MOVED, hasReached, setStatus, statusOf
+from orgSnapshot import readSnapshot
+from orgThrottle import AdaptiveLimiter
 
 ROLE_ARN=os.environ['ROLE_ARN']
 ACCOUNT_TABLE_NAME=os.environ['ACCOUNT_TABLE_NAME']
@@ -14,107 +19,142 @@ ACCEPT_ROLE_NAME=os.environ['ACCEPT_ROLE_NAME']
 OLD_ORG_MA=os.environ['OLD_ORG_MA']
 OLD_MASTER_OU=os.environ['OLD_MASTER_OU']
 
-ddb_client=boto3.client('dynamodb')
-new_org_client=boto3.client('organizations')
-s3_clinet=boto3.client('s3')
+ddb_client=lazyClient('dynamodb')
+new_org_client=lazyClient('organizations', limiter=AdaptiveLimiter())
+s3_client=lazyClient('s3')
+old_org_client=lazyClient('organizations', role_arn=ROLE_ARN, limiter=AdaptiveLimiter())
 
-def aws_session(role_arn=None, session_name='ma_session'):
+def getMasterProgress(old_master_id):
     """
-    If role_arn is given assumes a role and returns boto3 session
-    otherwise return a regular session with the current IAM user/role
+    Returns the migration status and handshake id recorded for the old
+    management account
     """
-    if role_arn:
-        client=boto3.client('sts')
-        try:
-            response=client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)
-            session=boto3.Session(
-                aws_access_key_id=response['Credentials']['AccessKeyId'],
-                aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-                aws_session_token=response['Credentials']['SessionToken'])
-            return session
-        except botocore.exceptions.ClientError as error:
-            print ('Caught exception creating a session')
-            print(error)
-    else:
-        return boto3.Session()
-
-session_assumed=aws_session(role_arn=ROLE_ARN, session_name='ma_session')    
-old_org_client=session_assumed.client('organizations')
-
-def acceptInvitation(old_master_id, account_parent_name, new_root_id):
-    # S3 Copy
-    # EDP Email
-    # ACCEPT_ROLE_ARN="arn:aws:iam::"+old_master_id+":role/"+ACCEPT_ROLE_NAME
-    # print('Role name is' + ACCEPT_ROLE_ARN)
-
     try:
-        delete_response = old_org_client.delete_organization()
-        print(delete_response)
-    except botocore.exceptions.ClientError as error:
-        print ('Caught exception deleting old organizations')
-        print(error)
-
-    try:
-        new_org_invite=new_org_client.invite_account_to_organization(
-            Target={
-                'Type': 'ACCOUNT',
-                'Id': old_master_id            },
-            Notes='Invitaion to join the new Org'
-            )
-        handshake_id=new_org_invite['Handshake']['Id']
-        print(handshake_id)
-    except botocore.exceptions.ClientError as error:
-        print ('Caught exception inviting account')
-        print(error)
-
-    try:
-        ddb_client.update_item(
+        account_info=ddb_client.get_item(
             TableName=ACCOUNT_TABLE_NAME,
             Key={
                 'AccountId': {'S': old_master_id}
             },
-            UpdateExpression="SET HandshakeId = :NewHandshakeId",
-            ExpressionAttributeValues={":NewHandshakeId": {"S": handshake_id}}
-        )        
+            AttributesToGet=[
+                "MigrationStatus",
+                "HandshakeId"
+            ]
+        )
+        item=account_info.get('Item', {})
+        return statusOf(item), item.get('HandshakeId', {}).get('S')
     except botocore.exceptions.ClientError as error:
-        print ('Caught exception updating item')
+        print ('Caught exception getting item')
         print(error)
+        return PENDING, None
 
+def getNewOuId(old_ou_id):
+    """
+    Returns the id of the new OU for the old management account from the
+    snapshot written by replicateOuStructure, or from the OU table
+    """
+    tree=readSnapshot(s3_client)
+    if tree is not None and old_ou_id in tree.ou_index and tree.ou(old_ou_id).new_id:
+        return tree.ou(old_ou_id).new_id
     try:
         ou_info=ddb_client.get_item(
             TableName=OU_TABLE_NAME,
             Key={
-                'OuName': {'S': account_parent_name}
+                'OuId': {'S': old_ou_id}
             },
             AttributesToGet=[
                 "NewOuId"
             ]
         )
-        new_ou_id=ou_info['Item']['NewOuId']['S']
     except botocore.exceptions.ClientError as error:
         print ('Caught exception scanning getting item')
         print(error)
+        return None
+    if 'NewOuId' not in ou_info.get('Item', {}):
+        event_log.account(OLD_ORG_MA, Skipped='the OU ' + old_ou_id + ' was not replicated')
+        return None
+    return ou_info['Item']['NewOuId']['S']
 
-    try:
-        accept_response = old_org_client.accept_handshake(
-            HandshakeId = handshake_id
-        )
-        print(accept_response)
-    except botocore.exceptions.ClientError as error:
-        print ('Caught exception Accepting handshake')
-        print(error)
+def acceptInvitation(old_master_id, account_parent_id, new_root_id):
+    # S3 Copy
+    # EDP Email
+    # ACCEPT_ROLE_ARN="arn:aws:iam::"+old_master_id+":role/"+ACCEPT_ROLE_NAME
+    # print('Role name is' + ACCEPT_ROLE_ARN)
+
+    # The management account leaves by deleting the old organization before
+    # it is invited, so it goes from INVITED straight to ACCEPTED
+    status, handshake_id=getMasterProgress(old_master_id)
+    if status == MOVED:
+        event_log.account(old_master_id, Status=MOVED, Skipped='already moved')
+        return
+
+    if not hasReached(status, INVITED):
+        try:
+            old_org_client.delete_organization()
+            event_log.event('moveMaster', 'deleteOrganization', Account=old_master_id)
+        except botocore.exceptions.ClientError as error:
+            event_log.event('moveMaster', 'deleteOrganizationFailed', ERROR, Account=old_master_id, Error=str(error))
+
+        try:
+            new_org_invite=new_org_client.invite_account_to_organization(
+                Target={
+                    'Type': 'ACCOUNT',
+                    'Id': old_master_id            },
+                Notes='Invitaion to join the new Org'
+                )
+            handshake_id=new_org_invite['Handshake']['Id']
+        except botocore.exceptions.ClientError as error:
+            event_log.event('moveMaster', 'inviteAccountFailed', ERROR, Account=old_master_id, Error=str(error))
+            return
+
+        try:
+            if not setStatus(ddb_client, ACCOUNT_TABLE_NAME, old_master_id, INVITED, {'HandshakeId': {'S': handshake_id}}):
+                return
+            event_log.account(old_master_id, Status=INVITED, Handshake=handshake_id)
+        except botocore.exceptions.ClientError as error:
+            event_log.event('moveMaster', 'recordStatusFailed', ERROR, Account=old_master_id, Error=str(error))
+            return
+
+    new_ou_id=getNewOuId(account_parent_id)
+    if new_ou_id is None:
+        return
+
+    if not hasReached(status, ACCEPTED):
+        if handshake_id is None:
+            event_log.account(old_master_id, Skipped='no handshake id was recorded')
+            return
+        try:
+            old_org_client.accept_handshake(
+                HandshakeId = handshake_id
+            )
+        except botocore.exceptions.ClientError as error:
+            event_log.event('moveMaster', 'acceptHandshakeFailed', ERROR, Account=old_master_id, Handshake=handshake_id, Error=str(error))
+            return
+
+        try:
+            if not setStatus(ddb_client, ACCOUNT_TABLE_NAME, old_master_id, ACCEPTED, previous=INVITED):
+                return
+            event_log.account(old_master_id, Status=ACCEPTED)
+        except botocore.exceptions.ClientError as error:
+            event_log.event('moveMaster', 'recordStatusFailed', ERROR, Account=old_master_id, Error=str(error))
+            return
 
     try:
-        move_response = new_org_client.move_account(
+        new_org_client.move_account(
             AccountId=old_master_id,
             SourceParentId=new_root_id,
             DestinationParentId=new_ou_id
         )
-        print(move_response)
     except botocore.exceptions.ClientError as error:
-        print ('Caught exception moving account')
-        print(error)
+        event_log.event('moveMaster', 'moveAccountFailed', ERROR, Account=old_master_id, Ou=new_ou_id, Error=str(error))
+        return
+
+    try:
+        if setStatus(ddb_client, ACCOUNT_TABLE_NAME, old_master_id, MOVED):
+            event_log.account(old_master_id, Status=MOVED, NewOu=new_ou_id)
+    except botocore.exceptions.ClientError as error:
+        event_log.event('moveMaster', 'recordStatusFailed', ERROR, Account=old_master_id, Error=str(error))
                                 
+@instrumented
 def lambda_handler(event, context):
     new_root_id=new_org_client.list_roots()["Roots"][0]["Id"]
     # **** S3 Copy ****
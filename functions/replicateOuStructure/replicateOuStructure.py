@@ -3,172 +3,200 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 '''
 
-import boto3
 import botocore
 import os
+from apiMetrics import instrumented
+from awsClients import lazyClient
+from concurrent.futures import ThreadPoolExecutor
+from ddbReader import scanTable
+from ddbSink import DdbSink
+from eventLog import DEBUG, WARNING, ERROR, event_log
+from orgModel import OrgTree
+from orgSnapshot import readSnapshot, writeSnapshot
+from orgThrottle import AdaptiveLimiter
 
 ROLE_ARN = os.environ['ROLE_ARN']
 OU_TABLE_NAME=os.environ['OU_TABLE_NAME']
 OLD_MASTER_OU=os.environ['OLD_MASTER_OU']
+REPLICATE_WORKERS=int(os.environ.get('REPLICATE_WORKERS', '8'))
+# 'table' replicates the OU tree stored by scanOldOrg, from its snapshot in
+# Amazon S3 if there is one, 'org' walks the old organization again
+REPLICATE_FROM=os.environ.get('REPLICATE_FROM', 'table')
 
-ddb_client=boto3.client('dynamodb')
+ddb_client=lazyClient('dynamodb')
+ddb_sink=DdbSink(ddb_client, {OU_TABLE_NAME: ['OuId']})
+s3_client=lazyClient('s3')
 
-def aws_session(role_arn=None, session_name='ma_session'):
+# Tree of the old organization in table mode, the new OU ids are recorded
+# on it and written back to the snapshot
+org_tree=None
+
+# The old and the new organization are throttled separately, each has
+# its own adaptive limiter
+old_org_client=lazyClient('organizations', role_arn=ROLE_ARN, max_pool_connections=REPLICATE_WORKERS, limiter=AdaptiveLimiter())
+new_org_client=lazyClient('organizations', max_pool_connections=REPLICATE_WORKERS, limiter=AdaptiveLimiter())
+
+def listChildOus(parent):
     """
-    If role_arn is given assumes a role and returns boto3 session
-    otherwise return a regular session with the current IAM user/role
+    Returns the OUs directly under an OU of the old organization, each with
+    the id of the new OU that its copy has to be created in
     """
-    if role_arn:
-        client=boto3.client('sts')
-        try:
-            response=client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)
-            session=boto3.Session(
-                aws_access_key_id=response['Credentials']['AccessKeyId'],
-                aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-                aws_session_token=response['Credentials']['SessionToken'])
-            return session
-        except botocore.exceptions.ClientError as error:
-            print ('Caught exception creating a session')
-            print(error)
-    else:
-        return boto3.Session()
-
-session_assumed = aws_session(role_arn=ROLE_ARN, session_name='ma_session')
+    old_parent_id, old_parent_name, new_parent_id, indent=parent
+    children=[]
+    try:
+        paginator = old_org_client.get_paginator('list_organizational_units_for_parent')
+        for page in paginator.paginate(ParentId=old_parent_id):
+            for ou in page['OrganizationalUnits']:
+                event_log.event('replicate', 'ouListed', DEBUG, sampled=True, Ou=ou['Id'], Name=ou['Name'], Parent=old_parent_id, Depth=indent + 1)
+                children.append((ou['Id'], ou['Name'], new_parent_id, indent + 1))
+    except botocore.exceptions.ClientError as error:
+        event_log.event('replicate', 'listChildrenFailed', ERROR, Ou=old_parent_id, Error=str(error))
+    return children
 
-old_org_client=session_assumed.client('organizations')
-new_org_client=boto3.client('organizations')
+def loadOuTree():
+    """
+    Reads the OU table written by scanOldOrg once and returns it as an
+    OrgTree of the old organization. The OU for the old management account
+    is kept with its new id, treeChildOus does not replicate it
+    """
+    items=scanTable(ddb_client, OU_TABLE_NAME, AttributesToGet=['OuId', 'OuName', 'OuParentId', 'OuParentType', 'OuParentName', 'OuPath', 'NewOuId'])
+    return OrgTree.fromOuItems(items)
 
-def createOUStructure(old_parent_id, old_parent_name, new_parent_id, indent):
+def treeChildOus(tree):
+    """
+    Returns a replacement for listChildOus that reads the children from the
+    OU tree loaded from the table, without calls to the old organization
+    """
+    def listChildren(parent):
+        old_parent_id, old_parent_name, new_parent_id, indent=parent
+        if old_parent_id not in tree.ou_index:
+            return []
+        return [(ou.id, ou.name, new_parent_id, indent + 1) for ou in tree.children(old_parent_id) if ou.id != OLD_MASTER_OU]
+    return listChildren
+
+def createNewOu(new_parent_id, name):
+    """
+    Creates the OU name under new_parent_id in the new organization and
+    returns its id. An OU of that name left by an earlier run is reused
+    """
     try:
-        paginator = old_org_client.get_paginator('list_children')
-        iterator = paginator.paginate(ParentId=old_parent_id, ChildType='ORGANIZATIONAL_UNIT')
-        indent += 1
+        return new_org_client.create_organizational_unit(ParentId=new_parent_id, Name=name)['OrganizationalUnit']['Id']
     except botocore.exceptions.ClientError as error:
-        print ('Caught exception listing children')
-        print(error)
-
-    for page in iterator:
-        #print(page)
-        for ou in page['Children']:
-            try:
-                #print(ou)
-                old_ou_info=old_org_client.describe_organizational_unit(OrganizationalUnitId=ou['Id'])
-                old_ou_id=old_ou_info['OrganizationalUnit']['Id']
-                old_ou_name=old_ou_info['OrganizationalUnit']['Name']
-                print(" ")
-                print(f"{'-' * indent}" + " | " + old_ou_id + " | " + old_ou_name + " | " + old_parent_id)
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception describing OU')
-                print(error)
-            
-            #Check if the parent of old ou is root
-            if old_parent_name != "Root":
-                try:
-                    old_parent_name_obj=ddb_client.get_item(
-                        TableName=OU_TABLE_NAME,
-                        Key={
-                            'OuName': {'S': old_ou_name}
-                        },
-                        AttributesToGet=[
-                            "OuParentName"
-                        ]
-                    )
-                    print(' ')
-                    old_parent_name=old_parent_name_obj['Item']['OuParentName']['S']
-                    #print('Parent of the OU is ' + old_parent_name)
-                except botocore.exceptions.ClientError as error:
-                    print ('Caught exception getting item')
-                    print(error)
-
-                try:
-                    response=ddb_client.get_item(
-                        TableName=OU_TABLE_NAME,
-                        Key={
-                            'OuName': {'S': old_parent_name}
-                        },
-                        AttributesToGet=[
-                            "NewOuId"
-                        ]
-                    )
-                    print(' ')
-                    new_parent_id=response['Item']['NewOuId']['S']
-                    #print(new_parent_id)
-                except botocore.exceptions.ClientError as error:
-                    print ('Caught exception getting item')
-                    print(error)
-            
-            #Create OU
-            try:
-                create_new_ou=new_org_client.create_organizational_unit(ParentId=new_parent_id, Name=old_ou_name)
-                new_ou_id=create_new_ou['OrganizationalUnit']['Id']
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception creating OU')
-                print(error)
-
-            try:
-                #print('adding new ou id')
-                ddb_client.update_item(
-                    TableName=OU_TABLE_NAME,
-                    Key={
-                    'OuName': {'S': old_ou_name}
-                    },
-                    UpdateExpression="SET NewOuId = :NewOu",
-                    ExpressionAttributeValues={":NewOu": {"S": new_ou_id}}
-                )
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception updating item')
-                print(error)
-
-            try:            
-                #print('adding new ou parent id')
-                ddb_client.update_item(
-                    TableName=OU_TABLE_NAME,
-                    Key={
-                    'OuName': {'S': old_ou_name}
-                    },
-                    UpdateExpression="SET NewOuParentId = :NewOu",
-                    ExpressionAttributeValues={":NewOu": {"S": new_parent_id}}
-                )
-                
-                print(f"{'-' * indent}" + " | " + new_ou_id + " | " + old_ou_name + " | " + new_parent_id)
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception updating item')
-                print(error)
-
-
-            createOUStructure(ou['Id'], old_ou_name, new_parent_id, indent)
+        if error.response['Error']['Code'] != 'DuplicateOrganizationalUnitException':
+            raise
+    paginator=new_org_client.get_paginator('list_organizational_units_for_parent')
+    for page in paginator.paginate(ParentId=new_parent_id):
+        for ou in page['OrganizationalUnits']:
+            if ou['Name'] == name:
+                return ou['Id']
+    raise LookupError('OU ' + name + ' not found under ' + new_parent_id)
+
+def createOu(child):
+    """
+    Creates the copy of an old OU in the new organization and returns it as
+    a parent for the next level, None if it could not be created. An OU
+    whose copy is already recorded is not created again
+    """
+    old_ou_id, old_ou_name, new_parent_id, indent=child
+    if org_tree is not None and old_ou_id in org_tree.ou_index and org_tree.ou(old_ou_id).new_id:
+        event_log.event('replicate', 'ouSkipped', DEBUG, sampled=True, Ou=old_ou_id, NewOu=org_tree.ou(old_ou_id).new_id, Depth=indent)
+        return (old_ou_id, old_ou_name, org_tree.ou(old_ou_id).new_id, indent)
+    try:
+        new_ou_id=createNewOu(new_parent_id, old_ou_name)
+        event_log.event('replicate', 'ouCreated', DEBUG, sampled=True, Ou=old_ou_id, NewOu=new_ou_id, Name=old_ou_name, Parent=new_parent_id, Depth=indent)
+    except (botocore.exceptions.ClientError, LookupError) as error:
+        event_log.event('replicate', 'createOuFailed', ERROR, Ou=old_ou_id, Name=old_ou_name, Parent=new_parent_id, Error=str(error))
+        return None
+
+    if org_tree is not None and old_ou_id in org_tree.ou_index:
+        org_tree.ou(old_ou_id).new_id=new_ou_id
+
+    #Both new ids are written with a single request when the sink is flushed
+    ddb_sink.update(OU_TABLE_NAME, {'OuId': {'S': old_ou_id}}, {
+        'NewOuId': {'S': new_ou_id},
+        'NewOuParentId': {'S': new_parent_id}
+    })
+    return (old_ou_id, old_ou_name, new_ou_id, indent)
+
+def createOUStructure(old_root_id, old_root_name, new_root_id, list_children=listChildOus):
+    """
+    Replicates the OU tree level by level. The OUs of one depth do not
+    depend on each other, so once the previous depth exists they are listed
+    and created concurrently on a pool of REPLICATE_WORKERS threads, and
+    the time grows with the depth of the tree rather than its size
+    """
+    level=[(old_root_id, old_root_name, new_root_id, 0)]
+    with ThreadPoolExecutor(max_workers=REPLICATE_WORKERS) as executor:
+        while level:
+            children=[child for listed in executor.map(list_children, level) for child in listed]
+            level=[created for created in executor.map(createOu, children) if created]
 
+@instrumented
 def lambda_handler(event, context):
+    global org_tree
+    org_tree=None
+    old_root_id=None
+    old_root_name="Root"
+    list_children=listChildOus
+    if REPLICATE_FROM == 'table':
+        try:
+            org_tree=readSnapshot(s3_client) or loadOuTree()
+            for old_root in org_tree.roots():
+                old_root_id=old_root.id
+                old_root_name=old_root.name
+            list_children=treeChildOus(org_tree)
+        except botocore.exceptions.ClientError as error:
+            print ('Caught exception scanning DynamoDB table')
+            print(error)
+            org_tree=None
+        #Without a scanned root, e.g. when the OU table is empty, the
+        #structure is read from the old organization
+        if old_root_id is None:
+            event_log.event('replicate', 'noScannedTree', WARNING)
+            org_tree=None
+            list_children=listChildOus
+
     try:
-        old_root_id=old_org_client.list_roots()["Roots"][0]["Id"]
-        old_root_name=old_org_client.list_roots()["Roots"][0]["Name"]
         new_root_id=new_org_client.list_roots()["Roots"][0]["Id"]
+        #The old root is only listed if it is not known from the OU table
+        if old_root_id is None:
+            old_root=old_org_client.list_roots()["Roots"][0]
+            old_root_id=old_root["Id"]
+            old_root_name=old_root["Name"]
     except botocore.exceptions.ClientError as error:
         print ('Caught exception listing roots')
-        print(error)    
-
-    try:
-        old_master_ou=new_org_client.create_organizational_unit(ParentId=new_root_id, Name=OLD_MASTER_OU)
-        old_master_ou_id=old_master_ou['OrganizationalUnit']['Id']
-    except botocore.exceptions.ClientError as error:
-        print ('Caught exception creating OU')
         print(error)
+        raise
 
+    #The OU for the old management account is reused if a previous run
+    #created it
     try:
-        ddb_client.put_item(
-            TableName=OU_TABLE_NAME,
-                Item={
-                    'OuId': {'S': old_master_ou_id},
-                    'OuName': {'S': OLD_MASTER_OU},
-                    'OuParentId': {'S': old_root_id},
-                    'OuParentType': {'S': "ROOT"},
-                    'OuParentName': {'S': "Root"},
-                    'NewOuId': {'S': old_master_ou_id},
-                    'NewOuParentId': {'S': new_root_id}
-                })
-    except botocore.exceptions.ClientError as error:
-        print ('Caught exception putting item')
-        print(error)
-
-    createOUStructure(old_root_id, old_root_name, new_root_id, 0)
+        if org_tree is not None and OLD_MASTER_OU in org_tree.ou_index and org_tree.ou(OLD_MASTER_OU).new_id:
+            old_master_ou_id=org_tree.ou(OLD_MASTER_OU).new_id
+        else:
+            old_master_ou_id=createNewOu(new_root_id, OLD_MASTER_OU)
+    except (botocore.exceptions.ClientError, LookupError) as error:
+        event_log.event('replicate', 'createOuFailed', ERROR, Ou=OLD_MASTER_OU, Name=OLD_MASTER_OU, Parent=new_root_id, Error=str(error))
+        raise
+
+    #The OU for the old management account has no id in the old organization,
+    #it is stored under its name, which can not collide with an OU id
+    ddb_sink.put(OU_TABLE_NAME, {
+        'OuId': {'S': OLD_MASTER_OU},
+        'OuName': {'S': OLD_MASTER_OU},
+        'OuParentId': {'S': old_root_id},
+        'OuParentType': {'S': "ROOT"},
+        'OuParentName': {'S': "Root"},
+        'OuPath': {'S': old_root_id + '/' + OLD_MASTER_OU},
+        'NewOuId': {'S': old_master_ou_id},
+        'NewOuParentId': {'S': new_root_id}
+    })
+
+    createOUStructure(old_root_id, old_root_name, new_root_id, list_children)
+    ddb_sink.flush()
+
+    #The snapshot is written again with the new OU ids for the later stages
+    if org_tree is not None and old_root_id in org_tree.ou_index:
+        org_tree.addOu(OLD_MASTER_OU, OLD_MASTER_OU, old_root_id).new_id=old_master_ou_id
+        writeSnapshot(s3_client, org_tree)
     
\ No newline at end of file
@@ -3,173 +3,376 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: Apache-2.0
 '''
 
-import boto3
 import botocore
+import itertools
 import os
+import queue
+import time
+from apiMetrics import api_metrics, instrumented
+from awsClients import lazyClient
+from botocore.paginate import TokenEncoder
+from concurrent.futures import ThreadPoolExecutor
+from ddbReader import getItems
+from ddbSink import DdbSink
+from eventLog import DEBUG, ERROR, event_log
+from migrationStatus import PENDING
+from orgModel import OrgTree
+from orgSnapshot import SNAPSHOT_BUCKET, readCheckpoint, readSnapshot, writeCheckpoint, writeSnapshot
+from orgThrottle import RETRY_CODES, AdaptiveLimiter, errorCode
 
 ROLE_ARN=os.environ['ROLE_ARN']
 OLD_ORG_MA=os.environ['OLD_ORG_MA']
 OU_TABLE_NAME=os.environ['OU_TABLE_NAME']
 ACCOUNT_TABLE_NAME=os.environ['ACCOUNT_TABLE_NAME']
+OLD_MASTER_OU=os.environ.get('OLD_MASTER_OU', 'OldMasterOU')
+SCAN_WORKERS=int(os.environ.get('SCAN_WORKERS', '8'))
+# Nodes buffered between the crawl and the writes, the workers wait while
+# the buffer is full so the crawl does not outrun the DynamoDB writes
+SCAN_QUEUE_NODES=int(os.environ.get('SCAN_QUEUE_NODES', '500'))
+# OUs whose new ids are read with one BatchGetItem
+PROGRESS_BATCH=100
+# 'full' writes every OU and account, 'delta' compares them with the previous
+# snapshot and only writes the ones that changed
+SCAN_MODE=os.environ.get('SCAN_MODE', 'full')
+# Seconds left to the function timeout at which the scan stops, writes a
+# checkpoint and returns a continuation for its next invocation
+SCAN_TIME_MARGIN=int(os.environ.get('SCAN_TIME_MARGIN', '10'))
+# 'true' logs every account with the path of its parent once the scan is complete
+SCAN_REPORT=os.environ.get('SCAN_REPORT', 'false').lower() == 'true'
+# What is left to scan of an OU, see scanOu
+ACCOUNTS='accounts'
+OUS='ous'
+# Kinds of the nodes yielded by traverseOrg
+OU_NODE='ou'
+ACCOUNT_NODE='account'
 
-def aws_session(role_arn=None, session_name='ma_session'):
+_OU_SCANNED=object()
+
+org_limiter=AdaptiveLimiter()
+org_client=lazyClient('organizations', role_arn=ROLE_ARN, max_pool_connections=SCAN_WORKERS, limiter=org_limiter)
+ddb_client=lazyClient('dynamodb', max_pool_connections=SCAN_WORKERS)
+ddb_sink=DdbSink(ddb_client, {OU_TABLE_NAME: ['OuId'], ACCOUNT_TABLE_NAME: ['AccountId']})
+s3_client=lazyClient('s3')
+
+def findOrgInfo():
     """
-    If role_arn is given assumes a role and returns boto3 session
-    otherwise return a regular session with the current IAM user/role
+    Logs every account of the organization with its parent and the path of
+    the parent. Everything is read from org_tree once the scan is complete,
+    so the report makes no API calls
     """
-    if role_arn:
-        client=boto3.client('sts')
-        try:
-            response=client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)
-            session=boto3.Session(
-                aws_access_key_id=response['Credentials']['AccessKeyId'],
-                aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-                aws_session_token=response['Credentials']['SessionToken'])
-            return session
-        except botocore.exceptions.ClientError as error:
-            print ('Caught exception creating a session')
-            print(error)
-    else:
-        return boto3.Session()
-
-session_assumed=aws_session(role_arn=ROLE_ARN, session_name='ma_session')
-session_regular=aws_session()
-    
-org_client=session_assumed.client('organizations')
-ddb_client=boto3.client('dynamodb')
-        
-def findOrgInfo(session_assumed, account):
-    org_client=session_assumed.client('organizations')
-    org_info=org_client.list_accounts()
-    
-    for accounts in org_info['Accounts']:
-        account_id=accounts['Id']
-        account_name=accounts['Name']
-        account_email=accounts['Email']
-        account_arn=accounts['Arn']
-        print(account_id + '|' + account_name + '|' + account_email + '|' + account_arn)
-        
-        try:
-            parent_info=org_client.list_parents(ChildId=account_id)
-            for parents in parent_info['Parents']:
-                parent_id=parents['Id']
-                parent_type=parents['Type']
-                print(account_id + '|' + account_name + '|' + account_email + '|' + account_arn + '|' + parent_id + '|' + parent_type)
-                
-                while parent_type != "ROOT":
-                    print('working on account: ' + account_name)
-                    ou_id=parent_id
-                    ou_type=parent_type
-                    ou_info=org_client.describe_organizational_unit(OrganizationalUnitId=parent_id)
-                    ou_name=ou_info['OrganizationalUnit']['Name']
-                    ou_arn=ou_info['OrganizationalUnit']['Arn']
-                    print(ou_id + '|' + ou_name + '|' + ou_arn + '|' + ou_type)                #print('parent info')
-                    parent_info=org_client.list_parents(ChildId=parent_id)
-                    parent_id=parent_info['Parents'][0]['Id']
-                    parent_type=parent_info['Parents'][0]['Type']
-        except botocore.exceptions.ClientError as error:
-            print ('Caught exception listing parents')
-            print(error)
-
-def getOuInfo(org_client, parent_id, indent):
-    paginator=org_client.get_paginator('list_children')
-    iterator=paginator.paginate(ParentId=parent_id, ChildType='ORGANIZATIONAL_UNIT')
-    indent += 1
-    for page in iterator:
-        for ou in page['Children']:
-            try:
-                ou_info=org_client.describe_organizational_unit(OrganizationalUnitId=ou['Id'])
-                ou_id=ou_info['OrganizationalUnit']['Id']
-                ou_name=ou_info['OrganizationalUnit']['Name']
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception describing organiation')
-                print(error)
-
-            try:
-                parent_info=org_client.list_parents(ChildId=ou_id)
-                for ids in parent_info['Parents']:
-                    ou_parent_id=ids['Id']
-                    ou_parent_type=ids['Type']
-                    if ou_parent_type == "ROOT":
-                        ou_parent_name=org_client.list_roots()["Roots"][0]["Name"]
-                    if ou_parent_type == "ORGANIZATIONAL_UNIT":
-                        ou_parent_info=org_client.describe_organizational_unit(OrganizationalUnitId=ou_parent_id)
-                        ou_parent_name=ou_parent_info['OrganizationalUnit']['Name']
-                #print(f"{'-' * indent}" + " | " + ou_id + " | " + ou_name + " | " + ou_arn )
-                print(f"{'-' * indent}" + " | " + ou_id + " | " + ou_name)
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception listing parents')
-                print(error)
-
-            try:
-                ddb_client.put_item(
-                TableName=OU_TABLE_NAME,
-                Item={
-                    'OuId': {'S': ou_id},
-                    'OuName': {'S': ou_name},
-                    'OuParentId': {'S': ou_parent_id},
-                    'OuParentType': {'S': ou_parent_type},
-                    'OuParentName': {'S': ou_parent_name}
-                })
-
-                getAccountInfo(org_client, ou['Id'], indent)
-                getOuInfo(org_client, ou['Id'], indent)
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception putting item in the DyanmodDb Table')
-                print(error)
-
-def getAccountInfo(org_client, parent_id, indent):
+    for account in org_tree.accounts:
+        parent=org_tree.ous[account.parent]
+        event_log.event('report', 'account', Account=account.id, Name=account.name, Email=account.email, Status=account.status, Parent=parent.id, ParentType=parent.type, Path=org_tree.path(parent.id))
+
+# Model of the old organization built by the crawl, reset on every run
+org_tree=OrgTree()
+# Snapshot of the previous scan in delta mode, None in full mode
+previous_tree=None
+# Ids of the OUs and the account items that changed since the previous scan
+changed_ous=[]
+changed_accounts=[]
+
+# Time at which the scan stops, None if it runs to the end
+deadline=None
+
+def timeUp():
+    return deadline is not None and time.time() >= deadline
+
+def resumeToken(page):
+    """
+    Returns the starting token for the paginator to continue after page, in
+    the encoding the paginator expects
+    """
+    return TokenEncoder().encode({'NextToken': page['NextToken']})
+
+# Written with if_not_exists, an account item keeps the status recorded by
+# the migration when it is scanned again
+ACCOUNT_DEFAULTS={'MigrationStatus': {'S': PENDING}}
+
+NEW_OU_ATTRIBUTES=['NewOuId', 'NewOuParentId']
+
+def loadNewOus(ou_ids):
+    """
+    Reads the ids of the copies of the given ou_ids that replicateOuStructure
+    recorded in the OU table, keyed by OU id
+    """
+    new_ous={}
     try:
-        account_paginator=org_client.get_paginator('list_children')
-        account_iterator=account_paginator.paginate(ParentId=parent_id, ChildType='ACCOUNT')
-        indent += 1
+        for ou in getItems(ddb_client, OU_TABLE_NAME, 'OuId', ou_ids, ['OuId'] + NEW_OU_ATTRIBUTES):
+            new_ous[ou['OuId']['S']]={name: ou[name] for name in NEW_OU_ATTRIBUTES if name in ou}
     except botocore.exceptions.ClientError as error:
-        print ('Caught exception listing children')
+        print ('Caught exception reading DynamoDB table')
         print(error)
+    return new_ous
+
+def withNewOus(items):
+    """
+    A put replaces the whole item, so the ids of the copies already created
+    in the new organization, NewOuId and NewOuParentId, are carried over, to
+    the items and to org_tree, and a rescan does not make the OUs be
+    created again
+    """
+    new_ous=loadNewOus([item['OuId']['S'] for item in items])
+    for item in items:
+        new_ou=new_ous.get(item['OuId']['S'], {})
+        item.update(new_ou)
+        if 'NewOuId' in new_ou:
+            org_tree.ou(item['OuId']['S']).new_id=new_ou['NewOuId']['S']
+    return items
+
+def ouChanged(item):
+    """
+    In delta mode, compares an OU item with the OU in the previous snapshot.
+    The id of the copy of the OU in the new organization is carried over to
+    org_tree, a rewritten item gets it from withNewOus
+    """
+    ou_id=item['OuId']['S']
+    if ou_id not in previous_tree.ou_index:
+        changed_ous.append(ou_id)
+        return True
+
+    old=previous_tree.ou(ou_id)
+    org_tree.ou(ou_id).new_id=old.new_id
+    old_parent=previous_tree.ous[old.parent]
+    if (old.name, old_parent.name, previous_tree.path(ou_id)) == (item['OuName']['S'], item['OuParentName']['S'], item['OuPath']['S']):
+        return False
+    changed_ous.append(ou_id)
+    return True
+
+def accountChanged(item):
+    """
+    In delta mode, compares an account item with the account in the previous
+    snapshot
+    """
+    account_id=item['AccountId']['S']
+    if account_id not in previous_tree.account_index:
+        return True
+    old=previous_tree.account(account_id)
+    old_parent=previous_tree.ous[old.parent]
+    new_parent=org_tree.ou(item['AccountParentId']['S'])
+    return (old.name, old.email, old.status, old_parent.id, old_parent.name) != (item['AccountName']['S'], item['AccountEmail']['S'], item['AccountStatus']['S'], new_parent.id, new_parent.name)
+
+def writeChangedAccounts():
+    """
+    Writes the account items that changed since the previous snapshot.
+    Returns the number of OUs and accounts that are no longer in the old
+    organization
+    """
+    sinkItems((ACCOUNT_TABLE_NAME, item) for item in changed_accounts)
+
+    # Items are never deleted, an account that left the old organization may
+    # still be migrating
+    removed_ous=[ou.id for ou in previous_tree.ous if ou.id not in org_tree.ou_index]
+    removed_accounts=[account.id for account in previous_tree.accounts if account.id not in org_tree.account_index]
+    event_log.event('delta', 'deltaScan', ChangedOus=len(changed_ous), ChangedAccounts=len(changed_accounts), RemovedOus=len(removed_ous), RemovedAccounts=len(removed_accounts))
+    return len(removed_ous) + len(removed_accounts)
+
+def getOuInfo(org_client, emit, parent_id, parent_name, parent_type, indent, token=None):
+    """
+    Emits the OUs directly under parent_id using the bulk listing, which
+    already returns the OU names, and returns them so they can be crawled
+    with their parent context instead of being looked up again.
+    The listing starts at the pagination token and stops early when the time
+    is up, or when a call fails because the time is up or it was still
+    throttled when its retries gave up. The OUs are returned
+    with False and the token to continue the listing with, None to start it
+    over, else with True
+    """
+    children=[]
+    try:
+        paginator=org_client.get_paginator('list_organizational_units_for_parent')
+        iterator=paginator.paginate(ParentId=parent_id, PaginationConfig={'StartingToken': token})
+        indent += 1
+        for page in iterator:
+            for ou in page['OrganizationalUnits']:
+                emit((OU_NODE, ou['Id'], ou['Name'], parent_id, parent_name, parent_type, indent))
+                children.append((ou['Id'], ou['Name'], 'ORGANIZATIONAL_UNIT', indent))
+            if page.get('NextToken'):
+                token=resumeToken(page)
+                if timeUp():
+                    return children, False, token
+    except botocore.exceptions.ClientError as error:
+        event_log.event('crawl', 'listOusFailed', ERROR, Parent=parent_id, Error=str(error))
+        if timeUp() or errorCode(error) in RETRY_CODES:
+            return children, False, token
+    return children, True, None
+
+def getAccountInfo(org_client, emit, parent_id, parent_name, indent, token=None):
+    """
+    Emits the accounts directly under the OU parent_id. The bulk listing
+    returns name, email and status, so no describe_account is needed.
+    Returns True once every account is listed, else False and the
+    pagination token to continue with, as getOuInfo
+    """
+    try:
+        account_paginator=org_client.get_paginator('list_accounts_for_parent')
+        account_iterator=account_paginator.paginate(ParentId=parent_id, PaginationConfig={'StartingToken': token})
+        indent += 1
+        for account_page in account_iterator:
+            for account in account_page['Accounts']:
+                emit((ACCOUNT_NODE, account['Id'], account['Name'], account['Email'], account['Status'], parent_id, parent_name, 'ORGANIZATIONAL_UNIT', indent))
+            if account_page.get('NextToken'):
+                token=resumeToken(account_page)
+                if timeUp():
+                    return False, token
+    except botocore.exceptions.ClientError as error:
+        event_log.event('crawl', 'listAccountsFailed', ERROR, Parent=parent_id, Error=str(error))
+        if timeUp() or errorCode(error) in RETRY_CODES:
+            return False, token
+    return True, None
+
+def scanOu(org_client, emit, ou_id, ou_name, ou_type, indent, stage=ACCOUNTS, token=None):
+    """
+    Emits the accounts and then the child OUs directly under one OU,
+    starting with stage at the pagination token. Returns the child OUs that
+    still have to be scanned, and the frontier entry to continue with the OU
+    if the time was up before it was done, else None. An OU whose scan only
+    starts once the time is up is left as it is
+    """
+    if timeUp():
+        return [], [ou_id, ou_name, ou_type, indent, stage, token]
+    if stage == ACCOUNTS:
+        if ou_type != 'ROOT':
+            finished, token=getAccountInfo(org_client, emit, ou_id, ou_name, indent, token)
+            if not finished:
+                return [], [ou_id, ou_name, ou_type, indent, ACCOUNTS, token]
+        token=None
+    children, finished, token=getOuInfo(org_client, emit, ou_id, ou_name, ou_type, indent, token)
+    if not finished:
+        return children, [ou_id, ou_name, ou_type, indent, OUS, token]
+    return children, None
+
+def _traverseOu(org_client, nodes, entry):
+    try:
+        nodes.put((_OU_SCANNED,) + scanOu(org_client, nodes.put, *entry))
+    except Exception as error:
+        nodes.put(error)
+
+def traverseOrg(org_client, frontier, left):
+    """
+    Crawls the OU tree from the frontier, the entries for scanOu, with a
+    bounded pool of workers and yields the OU and account nodes as they are
+    listed, every OU before the nodes under it. Sibling subtrees are scanned
+    in parallel and all workers share the token bucket attached to
+    org_client, so the crawl stays within the Organizations API rate. The
+    nodes pass through a bounded queue, a consumer that falls behind holds
+    the workers back. Once the time is up no more OUs are started, and the
+    frontier left to scan is added to left
+    """
+    nodes=queue.Queue(maxsize=SCAN_QUEUE_NODES)
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        running=0
+        for entry in frontier:
+            executor.submit(_traverseOu, org_client, nodes, entry)
+            running += 1
+        try:
+            while running:
+                node=nodes.get()
+                if isinstance(node, Exception):
+                    running -= 1
+                    raise node
+                if node[0] is not _OU_SCANNED:
+                    yield node
+                    continue
+                running -= 1
+                children, resume=node[1:]
+                if resume:
+                    left.append(resume)
+                for child in children:
+                    if timeUp():
+                        left.append(list(child))
+                    else:
+                        executor.submit(_traverseOu, org_client, nodes, child)
+                        running += 1
+        finally:
+            # The consumer stopped early, let the workers waiting on the
+            # queue finish
+            while running:
+                node=nodes.get()
+                if isinstance(node, Exception) or node[0] is _OU_SCANNED:
+                    running -= 1
+
+def enrichNodes(nodes):
+    """
+    Adds the nodes to org_tree, which gives the materialized path of OU ids,
+    and yields the table name and item to write for each of them. In delta
+    mode only the OUs that changed are yielded, the changed accounts are
+    kept for writeChangedAccounts. The new ids of the OUs yielded are read
+    in batches of PROGRESS_BATCH
+    """
+    ous=[]
+    for node in nodes:
+        if node[0] == OU_NODE:
+            kind, ou_id, ou_name, parent_id, parent_name, parent_type, indent=node
+            org_tree.addOu(ou_id, ou_name, parent_id)
+            event_log.event('crawl', 'ou', DEBUG, sampled=True, Ou=ou_id, Name=ou_name, Parent=parent_id, Depth=indent)
+            item={
+                'OuId': {'S': ou_id},
+                'OuName': {'S': ou_name},
+                'OuParentId': {'S': parent_id},
+                'OuParentType': {'S': parent_type},
+                'OuParentName': {'S': parent_name},
+                'OuPath': {'S': org_tree.path(ou_id)}
+            }
+            if previous_tree is not None and not ouChanged(item):
+                continue
+            ous.append(item)
+            if len(ous) >= PROGRESS_BATCH:
+                for item in withNewOus(ous):
+                    yield OU_TABLE_NAME, item
+                ous=[]
+            continue
+
+        kind, account_id, account_name, account_email, account_status, parent_id, parent_name, parent_type, indent=node
+        org_tree.addAccount(account_id, account_name, account_email, account_status, parent_id)
+        event_log.event('crawl', 'account', DEBUG, sampled=True, Account=account_id, Parent=parent_id, Depth=indent)
+        item={
+            'AccountId': {'S': account_id},
+            'AccountName': {'S': account_name},
+            'AccountEmail': {'S': account_email},
+            'AccountParentId': {'S': parent_id},
+            'AccountParentName': {'S': parent_name},
+            'AccountParentType': {'S': parent_type},
+            'AccountStatus': {'S': account_status}
+        }
+        if previous_tree is not None:
+            if accountChanged(item):
+                changed_accounts.append(item)
+            continue
+        yield ACCOUNT_TABLE_NAME, item
+    for item in withNewOus(ous):
+        yield OU_TABLE_NAME, item
+
+def sinkItems(items):
+    """
+    Writes the table name and item pairs through ddb_sink, the OUs as
+    batches of 25. The accounts are updated rather than replaced, the
+    attributes recorded by the migration, its status, invitation and claim,
+    are left as they are
+    """
+    for table_name, item in items:
+        if table_name == ACCOUNT_TABLE_NAME:
+            ddb_sink.update(table_name, item, item, ACCOUNT_DEFAULTS)
+        else:
+            ddb_sink.put(table_name, item)
+
+def scanOrg(org_client, frontier, nodes=()):
+    """
+    Runs the scan pipeline from the frontier, after the given nodes:
+    traverseOrg yields the nodes, enrichNodes turns them into items and
+    sinkItems writes them. Returns the frontier left when the time is up
+    """
+    left=[]
+    sinkItems(enrichNodes(itertools.chain(nodes, traverseOrg(org_client, frontier, left))))
+    return left
 
-    for account_page in account_iterator:
-        for account in account_page['Children']: 
-            try:           
-                account_info=org_client.describe_account(AccountId=account['Id'])
-                account_id=account_info['Account']['Id']
-                account_name=account_info['Account']['Name']
-                account_email=account_info['Account']['Email']
-                account_arn=account_info['Account']['Arn']
-                account_status=account_info['Account']['Status']
-                print(f"{'-' * indent}" + " | " +  account_id + " | " + account_name + " | " + account_email + " | " + account_status)
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception describing account')
-                print(error)
-
-            try:
-                parent_info=org_client.list_parents(ChildId=account_id)
-                for ids in parent_info['Parents']:
-                    account_parent_id=ids['Id']
-                    account_parent_type=ids['Type']
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception listing parents')
-                print(error)
-                
-            account_parent_info=org_client.describe_organizational_unit(OrganizationalUnitId=account_parent_id)
-            account_parent_name=account_parent_info['OrganizationalUnit']['Name']
-            try:
-                ddb_client.put_item(
-                TableName=ACCOUNT_TABLE_NAME,
-                Item={
-                    'AccountId': {'S': account_id},
-                    'AccountName': {'S': account_name},
-                    'AccountEmail': {'S': account_email},
-                    #'AccountArn': {'S': account_arn},
-                    'AccountParentId': {'S': account_parent_id},
-                    'AccountParentName': {'S': account_parent_name},
-                    'AccountParentType': {'S': account_parent_type},
-                    'AccountStatus': {'S': account_status}
-                })
-            except botocore.exceptions.ClientError as error:
-                print ('Caught exception putting item in the DyanmodDb Table')
-                print(error)
-    
 def getMasterAccountInfo(org_client, account_number):
+    """
+    Returns the node of the old management account as a list, which is
+    empty if the account can not be described. The crawl lists the accounts
+    of the OUs but not of the root, so the node is only returned if the
+    account is directly under the root
+    """
     try:
         account_info=org_client.describe_account(AccountId=account_number)
         account_id=account_info['Account']['Id']
@@ -178,8 +381,8 @@ def getMasterAccountInfo(org_client, account_number):
         account_arn=account_info['Account']['Arn']
         account_status=account_info['Account']['Status']
     except botocore.exceptions.ClientError as error:
-        print ('Caught exception describing account')
-        print(error)
+        event_log.event('crawl', 'describeAccountFailed', ERROR, Account=account_number, Error=str(error))
+        return []
 
     try:
         parent_info=org_client.list_parents(ChildId=account_id)
@@ -187,31 +390,85 @@ def getMasterAccountInfo(org_client, account_number):
             account_parent_id=ids['Id']
             account_parent_type=ids['Type']
     except botocore.exceptions.ClientError as error:
-        print ('Caught exception listing parents')
-        print(error)
+        event_log.event('crawl', 'listParentsFailed', ERROR, Account=account_id, Error=str(error))
+        return []
 
-    try:        
-        ddb_client.put_item(
-        TableName=ACCOUNT_TABLE_NAME,
-        Item={
-            'AccountId': {'S': account_id},
-            'AccountName': {'S': account_name},
-            'AccountEmail': {'S': account_email},
-            'AccountStatus': {'S': account_status},
-            'AccountParentId': {'S': account_parent_id},
-            'AccountParentName': {'S': "ROOT"},
-            'AccountParentType': {'S': account_parent_type},
-        })
-        #print(" "+ account_id + " | " + account_name + " | " + account_email + " | " + account_status)
-    except botocore.exceptions.ClientError as error:
-        print ('Caught exception putting item in the DyanmodDb Table')
-        print(error)
-    
+    if account_parent_type != 'ROOT':
+        return []
+    return [(ACCOUNT_NODE, account_id, account_name, account_email, account_status, account_parent_id, "ROOT", account_parent_type, 0)]
+
+@instrumented
 def lambda_handler(event, context):
-    root_id=org_client.list_roots()["Roots"][0]["Id"]
-    root_name=org_client.list_roots()["Roots"][0]["Name"]
-    root_arn=org_client.list_roots()["Roots"][0]["Arn"]
-    print(" "+ root_id + " | " + root_name)
+    global org_tree, previous_tree, deadline
+    #Without a bucket for the checkpoint the scan has to finish in one invocation
+    deadline=None
+    if context is not None and SNAPSHOT_BUCKET:
+        deadline=time.time() + context.get_remaining_time_in_millis() / 1000 - SCAN_TIME_MARGIN
+    #Throttled calls stop retrying at the deadline, the listing they belong
+    #to is continued by the next invocation
+    org_limiter.deadline=deadline
+    del changed_ous[:]
+    del changed_accounts[:]
+
+    #A continuation picks up the tree and the frontier where the previous
+    #invocation stopped, a missing checkpoint starts the scan over
+    frontier=None
+    continuation=((event or {}).get('Scan') or {}).get('Continuation')
+    if continuation:
+        tree, state=readCheckpoint(s3_client, continuation)
+        if tree is not None:
+            org_tree=tree
+            frontier=state['Frontier']
+            changed_ous.extend(state['ChangedOus'])
+            changed_accounts.extend(state['ChangedAccounts'])
+            event_log.event('crawl', 'scanContinued', Frontier=len(frontier))
+
+    #A delta scan falls back to a full scan if there is no previous snapshot
+    previous_tree=readSnapshot(s3_client) if SCAN_MODE == 'delta' else None
+    if frontier is None:
+        root=org_client.list_roots()["Roots"][0]
+        root_id=root["Id"]
+        root_name=root["Name"]
+        event_log.event('crawl', 'root', Root=root_id, Name=root_name)
+        org_tree=OrgTree()
+        org_tree.addOu(root_id, root_name)
+        with api_metrics.stage('crawl'):
+            frontier=scanOrg(org_client, [[root_id, root_name, 'ROOT', 0]], getMasterAccountInfo(org_client, OLD_ORG_MA))
+            ddb_sink.flush()
+    else:
+        with api_metrics.stage('crawl'):
+            frontier=scanOrg(org_client, frontier)
+            ddb_sink.flush()
+
+    if frontier:
+        with api_metrics.stage('checkpoint'):
+            version=writeCheckpoint(s3_client, org_tree, {'Frontier': frontier, 'ChangedOus': changed_ous, 'ChangedAccounts': changed_accounts})
+        if version is not None:
+            event_log.event('crawl', 'scanStopped', Frontier=len(frontier))
+            return {'Complete': False, 'Continuation': version}
+        deadline=None
+        org_limiter.deadline=None
+        with api_metrics.stage('crawl'):
+            scanOrg(org_client, frontier)
+
+    root_id=org_tree.roots()[0].id
+    removed=0
+    #The OU added by replicateOuStructure for the old management account
+    #is not in the old organization, it is kept with its new id
+    if previous_tree is not None:
+        if OLD_MASTER_OU in previous_tree.ou_index:
+            org_tree.addOu(OLD_MASTER_OU, OLD_MASTER_OU, root_id).new_id=previous_tree.ou(OLD_MASTER_OU).new_id
+        with api_metrics.stage('delta'):
+            removed=writeChangedAccounts()
+    else:
+        old_master_ou=loadNewOus([OLD_MASTER_OU]).get(OLD_MASTER_OU, {})
+        if 'NewOuId' in old_master_ou:
+            org_tree.addOu(OLD_MASTER_OU, OLD_MASTER_OU, root_id).new_id=old_master_ou['NewOuId']['S']
+    ddb_sink.flush()
 
-    getMasterAccountInfo(org_client, OLD_ORG_MA)
-    getOuInfo(org_client, root_id, 0)
\ No newline at end of file
+    if previous_tree is None or changed_ous or changed_accounts or removed:
+        with api_metrics.stage('snapshot'):
+            writeSnapshot(s3_client, org_tree)
+    if SCAN_REPORT:
+        findOrgInfo()
+    return {'Complete': True, 'Continuation': None}
@@ -0,0 +1,202 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+'''
+
+import functools
+import json
+import os
+import threading
+import time
+from botocore.utils import determine_content_length
+from contextlib import contextmanager
+from eventLog import LOG_FLUSH_MARGIN, event_log
+from orgThrottle import THROTTLE_CODES
+
+# Namespace of the metrics in Amazon CloudWatch
+METRICS_NAMESPACE=os.environ.get('METRICS_NAMESPACE', 'OrgMigration')
+# Upper bounds in milliseconds of the latency histogram buckets, the last
+# bucket counts everything slower
+LATENCY_BUCKETS=[10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+COUNTERS=['Calls', 'Errors', 'Retries', 'Throttles', 'BytesSent', 'BytesReceived']
+
+class ApiMetrics(object):
+    """
+    Records every API call of the clients it is attached to, per stage and
+    operation: calls, errors, retries, throttled attempts, bytes sent and
+    received, and a latency histogram. The latency of a call includes its
+    retries. The stage is the name of the function unless a part of it runs
+    in a stage()
+    """
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.function=None
+        self.current_stage=None
+        # (stage, operation) to the counters and histogram of the operation
+        self.operations={}
+
+    def reset(self, function):
+        with self.lock:
+            self.function=function
+            self.current_stage=function
+            self.operations={}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Records the calls started in the block, on any thread, under the
+        stage name
+        """
+        previous=self.current_stage
+        self.current_stage=name
+        try:
+            yield
+        finally:
+            self.current_stage=previous
+
+    def attach(self, client):
+        """
+        Registers the event hooks on the client and returns it
+        """
+        events=client.meta.events
+        events.register('before-call', self._beforeCall, unique_id='apiMetrics-before-call')
+        events.register('request-created', self._requestCreated, unique_id='apiMetrics-request-created')
+        events.register('needs-retry', self._needsRetry, unique_id='apiMetrics-needs-retry')
+        events.register('after-call', self._afterCall, unique_id='apiMetrics-after-call')
+        events.register('after-call-error', self._afterCallError, unique_id='apiMetrics-after-call-error')
+        return client
+
+    def _beforeCall(self, model, context, **kwargs):
+        context['api_metrics']={
+            'stage': self.current_stage,
+            'operation': model.service_model.service_name + '.' + model.name,
+            'start': time.time(),
+            'sent': 0,
+            'throttles': 0
+        }
+
+    def _requestCreated(self, request, **kwargs):
+        call=getattr(request, 'context', {}).get('api_metrics')
+        if call is not None and request.body is not None:
+            # Streamed uploads with a trailing checksum only carry the length
+            # of the payload in a header
+            call['sent'] += determine_content_length(request.body) or int(request.headers.get('X-Amz-Decoded-Content-Length', 0))
+
+    def _needsRetry(self, request_dict, response=None, **kwargs):
+        call=request_dict.get('context', {}).get('api_metrics')
+        if call is not None and response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            call['throttles'] += 1
+
+    def _afterCall(self, http_response, parsed, context, **kwargs):
+        # The length is taken from the header, reading the content would
+        # consume streamed bodies, e.g. of GetObject
+        self._record(context, http_response.status_code >= 300, int(http_response.headers.get('content-length', 0)))
+
+    def _afterCallError(self, context, **kwargs):
+        self._record(context, True, 0)
+
+    def _record(self, context, failed, received):
+        call=context.pop('api_metrics', None)
+        if call is None:
+            return
+        latency=(time.time() - call['start']) * 1000
+        bucket=len(LATENCY_BUCKETS)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                bucket=index
+                break
+        with self.lock:
+            key=(call['stage'], call['operation'])
+            if key not in self.operations:
+                self.operations[key]=dict({name: 0 for name in COUNTERS}, LatencySum=0.0, LatencyMax=0.0, Histogram=[0] * (len(LATENCY_BUCKETS) + 1))
+            operation=self.operations[key]
+            operation['Calls'] += 1
+            operation['Errors'] += 1 if failed else 0
+            operation['Retries'] += max(0, context.get('retries', {}).get('attempt', 1) - 1)
+            operation['Throttles'] += call['throttles']
+            operation['BytesSent'] += call['sent']
+            operation['BytesReceived'] += received
+            operation['LatencySum'] += latency
+            operation['LatencyMax']=max(operation['LatencyMax'], latency)
+            operation['Histogram'][bucket] += 1
+
+    def emit(self):
+        """
+        Prints one line in CloudWatch Embedded Metric Format per stage and
+        operation, CloudWatch Logs turns them into metrics
+        """
+        timestamp=int(time.time() * 1000)
+        with self.lock:
+            operations=sorted(self.operations.items())
+        for (stage, operation), values in operations:
+            line={
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [['Function', 'Stage', 'Operation'], ['Function', 'Operation']],
+                        'Metrics': [{'Name': name, 'Unit': 'Bytes' if name.startswith('Bytes') else 'Count'} for name in COUNTERS]
+                            + [{'Name': 'LatencyAverage', 'Unit': 'Milliseconds'}, {'Name': 'LatencyMax', 'Unit': 'Milliseconds'}]
+                    }]
+                },
+                'Function': self.function,
+                'Stage': stage,
+                'Operation': operation,
+                'LatencyAverage': round(values['LatencySum'] / values['Calls'], 1),
+                'LatencyMax': round(values['LatencyMax'], 1),
+                'LatencyHistogram': self._histogram(values['Histogram'])
+            }
+            line.update({name: values[name] for name in COUNTERS})
+            print(json.dumps(line, separators=(',', ':')))
+
+    def _histogram(self, counts):
+        labels=['<=' + str(bound) + 'ms' for bound in LATENCY_BUCKETS] + ['>' + str(LATENCY_BUCKETS[-1]) + 'ms']
+        return {label: count for label, count in zip(labels, counts) if count}
+
+    def summary(self):
+        """
+        Returns the metrics as a small JSON serializable dict keyed by
+        stage and operation
+        """
+        with self.lock:
+            operations=sorted(self.operations.items())
+        summary={}
+        for (stage, operation), values in operations:
+            entry={name: values[name] for name in COUNTERS if values[name]}
+            entry['LatencyAverage']=round(values['LatencySum'] / values['Calls'], 1)
+            entry['LatencyMax']=round(values['LatencyMax'], 1)
+            summary[stage + ':' + operation]=entry
+        return summary
+
+# Shared by every client awsClients creates
+api_metrics=ApiMetrics()
+
+def instrumented(handler):
+    """
+    Decorates a lambda_handler: the metrics and the event log are reset for
+    every invocation and written when it ends, and the metrics are added to
+    its result as ApiMetrics. The event log is also written LOG_FLUSH_MARGIN
+    seconds before the timeout, so it is not lost if the function times out
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        api_metrics.reset(handler.__module__)
+        event_log.reset(handler.__module__)
+        timer=None
+        if context is not None:
+            timer=threading.Timer(max(0, context.get_remaining_time_in_millis() / 1000 - LOG_FLUSH_MARGIN), event_log.flush)
+            timer.daemon=True
+            timer.start()
+        try:
+            result=handler(event, context)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            event_log.flush()
+            api_metrics.emit()
+        if result is None:
+            return {'ApiMetrics': api_metrics.summary()}
+        if isinstance(result, dict):
+            return dict(result, ApiMetrics=api_metrics.summary())
+        return result
+    return wrapper
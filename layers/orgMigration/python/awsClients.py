@@ -0,0 +1,170 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+'''
+
+import boto3
+import botocore.session
+import os
+import threading
+from apiMetrics import api_metrics
+from botocore.config import Config
+from botocore.credentials import DeferredRefreshableCredentials
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# Connections kept open per client, raise it for functions with more workers
+CLIENT_POOL_CONNECTIONS=int(os.environ.get('CLIENT_POOL_CONNECTIONS', '10'))
+# Roles assumed concurrently ahead of use by a CredentialBroker
+STS_PREFETCH_WORKERS=int(os.environ.get('STS_PREFETCH_WORKERS', '8'))
+# Cached credentials are assumed again when less than this many seconds are left
+CREDENTIAL_REFRESH_MARGIN=int(os.environ.get('CREDENTIAL_REFRESH_MARGIN', '300'))
+
+# Sessions and clients live at module level, so warm invocations reuse them
+# together with their credentials and open connections
+_sessions={}
+_clients={}
+# Creating sessions and clients is not thread-safe
+_lock=threading.RLock()
+
+def _baseSession():
+    with _lock:
+        if None not in _sessions:
+            _sessions[None]=boto3.Session()
+        return _sessions[None]
+
+def assumeRole(role_arn, session_name):
+    """
+    Assumes role_arn with the function's own credentials and returns the
+    temporary credentials in the format of botocore refreshable credentials
+    """
+    response=getClient('sts').assume_role(RoleArn=role_arn, RoleSessionName=session_name)
+    return {
+        'access_key': response['Credentials']['AccessKeyId'],
+        'secret_key': response['Credentials']['SecretAccessKey'],
+        'token': response['Credentials']['SessionToken'],
+        'expiry_time': response['Credentials']['Expiration'].isoformat()
+    }
+
+def aws_session(role_arn=None, session_name='ma_session'):
+    """
+    If role_arn is given returns a boto3 session for the assumed role
+    otherwise return a regular session with the current IAM user/role.
+    The role is only assumed when a client first needs credentials, and
+    assumed again shortly before they expire. Sessions are cached, so warm
+    invocations do not call STS again
+    """
+    if not role_arn:
+        return _baseSession()
+    key=(role_arn, session_name)
+    with _lock:
+        if key not in _sessions:
+            credentials=DeferredRefreshableCredentials(
+                refresh_using=lambda: assumeRole(role_arn, session_name),
+                method='sts-assume-role')
+            botocore_session=botocore.session.get_session()
+            botocore_session._credentials=credentials
+            _sessions[key]=boto3.Session(botocore_session=botocore_session)
+        return _sessions[key]
+
+def getClient(service, role_arn=None, session_name='ma_session', max_pool_connections=CLIENT_POOL_CONNECTIONS, limiter=None):
+    """
+    Returns the cached client for the service, created with the session of
+    role_arn and a connection pool of max_pool_connections. The API
+    metrics and a limiter, e.g. a TokenBucket, are attached when the client
+    is created, with the botocore retries the limiter asks for
+    """
+    key=(service, role_arn, session_name, max_pool_connections, id(limiter))
+    with _lock:
+        if key not in _clients:
+            config=Config(max_pool_connections=max_pool_connections, retries=limiter.retries if limiter else None)
+            client=api_metrics.attach(aws_session(role_arn, session_name).client(service, config=config))
+            _clients[key]=limiter.attach(client) if limiter else client
+        return _clients[key]
+
+def clientWithCredentials(service, credentials, limiter=None):
+    """
+    Creates an uncached client with credentials returned by assumeRole,
+    e.g. for one member account. It shares the models already loaded by
+    the regular session
+    """
+    with _lock:
+        client=_baseSession().client(
+            service,
+            aws_access_key_id=credentials['access_key'],
+            aws_secret_access_key=credentials['secret_key'],
+            aws_session_token=credentials['token'],
+            config=Config(retries=limiter.retries if limiter else None))
+    api_metrics.attach(client)
+    return limiter.attach(client) if limiter else client
+
+class CredentialBroker(object):
+    """
+    Assumes the role role_name in many accounts, e.g. the role every member
+    account has for the migration. The roles of the upcoming accounts are
+    assumed concurrently ahead of use and the credentials are cached until
+    shortly before they expire, so a retry in the same or a warm invocation
+    does not call STS again. A failed assume role is not cached
+    """
+    def __init__(self, role_name, session_name, workers=STS_PREFETCH_WORKERS):
+        self.role_name=role_name
+        self.session_name=session_name
+        self.executor=ThreadPoolExecutor(max_workers=workers)
+        # Account id to the future of its credentials
+        self.credentials={}
+        self.lock=threading.Lock()
+
+    def roleArn(self, account_id):
+        return 'arn:aws:iam::' + account_id + ':role/' + self.role_name
+
+    def _usable(self, future):
+        if not future.done():
+            return True
+        if future.exception() is not None:
+            return False
+        expiry=datetime.fromisoformat(future.result()['expiry_time'])
+        return (expiry - datetime.now(timezone.utc)).total_seconds() > CREDENTIAL_REFRESH_MARGIN
+
+    def _future(self, account_id):
+        with self.lock:
+            future=self.credentials.get(account_id)
+            if future is None or not self._usable(future):
+                future=self.executor.submit(assumeRole, self.roleArn(account_id), self.session_name)
+                self.credentials[account_id]=future
+            return future
+
+    def prefetch(self, account_ids):
+        """
+        Starts assuming the role in the accounts, in the given order
+        """
+        for account_id in account_ids:
+            self._future(account_id)
+
+    def get(self, account_id):
+        """
+        Returns the credentials for the account in the format of assumeRole,
+        waiting for a prefetch that is still running. Raises the ClientError
+        of a failed assume role
+        """
+        return self._future(account_id).result()
+
+class LazyClient(object):
+    """
+    Stands in for a client that is only created when it is first used, so
+    importing a function does not create clients or call STS
+    """
+    def __init__(self, service, **client_args):
+        self._service=service
+        self._client_args=client_args
+        self._client=None
+
+    def __getattr__(self, name):
+        if self._client is None:
+            self._client=getClient(self._service, **self._client_args)
+        return getattr(self._client, name)
+
+def lazyClient(service, **client_args):
+    """
+    Returns a LazyClient, client_args are the arguments of getClient
+    """
+    return LazyClient(service, **client_args)
@@ -0,0 +1,96 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+'''
+
+import os
+import queue
+import threading
+
+SCAN_SEGMENTS=int(os.environ.get('SCAN_SEGMENTS', '4'))
+# Pages buffered between the segment readers and the consumer
+QUEUE_PAGES=int(os.environ.get('SCAN_QUEUE_PAGES', '8'))
+
+_SEGMENT_DONE=object()
+
+def _scanSegment(ddb_client, pages, stop, segment, total_segments, scan_args):
+    try:
+        args=dict(scan_args, Segment=segment, TotalSegments=total_segments)
+        while not stop.is_set():
+            response=ddb_client.scan(**args)
+            pages.put(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            args['ExclusiveStartKey']=response['LastEvaluatedKey']
+        pages.put(_SEGMENT_DONE)
+    except Exception as error:
+        pages.put(error)
+
+def scanTable(ddb_client, table_name, total_segments=SCAN_SEGMENTS, **scan_args):
+    """
+    Reads the whole table with a parallel Scan and yields the items as the
+    pages arrive. Every segment follows LastEvaluatedKey until it is done,
+    so tables larger than one 1 MB page are read completely. Any other
+    Scan parameters, e.g. ProjectionExpression, are passed through.
+    A failing segment raises its exception in the consumer
+    """
+    scan_args['TableName']=table_name
+    pages=queue.Queue(maxsize=QUEUE_PAGES)
+    stop=threading.Event()
+    for segment in range(total_segments):
+        threading.Thread(
+            target=_scanSegment,
+            args=(ddb_client, pages, stop, segment, total_segments, scan_args),
+            daemon=True).start()
+
+    running=total_segments
+    try:
+        while running:
+            page=pages.get()
+            if page is _SEGMENT_DONE:
+                running -= 1
+            elif isinstance(page, Exception):
+                running -= 1
+                raise page
+            else:
+                for item in page:
+                    yield item
+    finally:
+        # A segment failed or the consumer stopped early, the other segments
+        # stop after their current page and the queue is drained so that
+        # none of them stays blocked on it
+        stop.set()
+        while running:
+            page=pages.get()
+            if page is _SEGMENT_DONE or isinstance(page, Exception):
+                running -= 1
+
+def queryTable(ddb_client, table_name, **query_args):
+    """
+    Runs a Query, e.g. on a secondary index, and yields the items of every
+    page, following LastEvaluatedKey
+    """
+    paginator=ddb_client.get_paginator('query')
+    for page in paginator.paginate(TableName=table_name, **query_args):
+        for item in page['Items']:
+            yield item
+
+def getItems(ddb_client, table_name, key_name, key_values, attributes):
+    """
+    Point reads of the items whose string key key_name is one of
+    key_values, 100 keys per BatchGetItem, retrying the UnprocessedKeys
+    """
+    items=[]
+    key_values=list(key_values)
+    for start in range(0, len(key_values), 100):
+        request_items={
+            table_name: {
+                'Keys': [{key_name: {'S': value}} for value in key_values[start:start + 100]],
+                'AttributesToGet': attributes
+            }
+        }
+        while request_items:
+            response=ddb_client.batch_get_item(RequestItems=request_items)
+            items.extend(response['Responses'].get(table_name, []))
+            request_items=response.get('UnprocessedKeys')
+    return items
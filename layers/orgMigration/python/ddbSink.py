@@ -0,0 +1,159 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+'''
+
+import botocore
+import random
+import threading
+import time
+from eventLog import DEBUG, ERROR, event_log
+
+BATCH_SIZE=25
+MAX_ATTEMPTS=8
+BASE_DELAY=0.05
+# Errors a write is retried on, any other error is raised at once
+RETRY_CODES=['ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded', 'InternalServerError']
+
+class DdbSink(object):
+    """
+    Write-behind buffer for DynamoDB tables.
+
+    Puts are sent as BatchWriteItem requests of up to 25 items and the
+    UnprocessedItems are retried with jittered exponential backoff. Writes
+    that still fail after MAX_ATTEMPTS, or fail with an error that is not
+    in RETRY_CODES, raise, so the function fails and its task is retried
+    instead of losing the items. Attribute
+    updates for the same key are merged, into the pending put for that key
+    if there is one, otherwise into a single UpdateItem, sent once 25 of
+    them are buffered or on flush().
+
+    table_keys maps every table name to the names of its key attributes,
+    e.g. {'Accounts': ['AccountId']}
+    """
+    def __init__(self, ddb_client, table_keys):
+        self.ddb_client=ddb_client
+        self.table_keys=table_keys
+        self.puts={table_name: {} for table_name in table_keys}
+        self.updates={table_name: {} for table_name in table_keys}
+        self.lock=threading.Lock()
+
+    def _key(self, table_name, item):
+        return tuple(item[name]['S'] for name in self.table_keys[table_name])
+
+    def put(self, table_name, item):
+        """
+        Buffers a put, replacing any pending put for the same key
+        """
+        key=self._key(table_name, item)
+        with self.lock:
+            item=dict(item)
+            attributes, defaults=self.updates[table_name].pop(key, ({}, {}))
+            for name, value in defaults.items():
+                item.setdefault(name, value)
+            item.update(attributes)
+            self.puts[table_name][key]=item
+            batch=self._takeBatch(table_name, BATCH_SIZE)
+        if batch:
+            self._writeBatch(table_name, batch)
+
+    def update(self, table_name, key, attributes, defaults=None):
+        """
+        Buffers SET updates of attributes (name to AttributeValue) on the item
+        with the given key, merging them with the pending writes for that key.
+        The key attributes are left out of the update. The defaults are only
+        set on attributes the item does not have yet, so an update does not
+        replace what other functions recorded
+        """
+        item_key=self._key(table_name, key)
+        attributes={name: value for name, value in attributes.items() if name not in self.table_keys[table_name]}
+        with self.lock:
+            if item_key in self.puts[table_name]:
+                item=self.puts[table_name][item_key]
+                for name, value in (defaults or {}).items():
+                    item.setdefault(name, value)
+                item.update(attributes)
+            else:
+                pending_attributes, pending_defaults=self.updates[table_name].setdefault(item_key, ({}, {}))
+                pending_attributes.update(attributes)
+                pending_defaults.update(defaults or {})
+            updates=self._takeUpdates(table_name, BATCH_SIZE)
+        for item_key, (attributes, defaults) in updates:
+            self._writeUpdate(table_name, item_key, attributes, defaults)
+
+    def flush(self):
+        """
+        Sends every buffered put and update
+        """
+        for table_name in self.table_keys:
+            while True:
+                with self.lock:
+                    batch=self._takeBatch(table_name, 1)
+                if not batch:
+                    break
+                self._writeBatch(table_name, batch)
+
+            with self.lock:
+                updates=self._takeUpdates(table_name, 1)
+            for item_key, (attributes, defaults) in updates:
+                self._writeUpdate(table_name, item_key, attributes, defaults)
+
+    def _takeUpdates(self, table_name, minimum):
+        # Called with the lock held
+        pending=self.updates[table_name]
+        if len(pending) < minimum:
+            return []
+        self.updates[table_name]={}
+        return list(pending.items())
+
+    def _takeBatch(self, table_name, minimum):
+        # Called with the lock held
+        pending=self.puts[table_name]
+        if len(pending) < minimum:
+            return []
+        keys=list(pending)[:BATCH_SIZE]
+        return [pending.pop(key) for key in keys]
+
+    def _retry(self, table_name, operation, error, attempt):
+        # Raises the error unless the write can be retried
+        if error.response['Error']['Code'] not in RETRY_CODES or attempt + 1 >= MAX_ATTEMPTS:
+            event_log.event('sink', operation + 'Failed', ERROR, Table=table_name, Attempt=attempt, Error=str(error))
+            raise error
+        event_log.event('sink', operation + 'Retry', DEBUG, sampled=True, Table=table_name, Attempt=attempt, Error=str(error))
+
+    def _writeBatch(self, table_name, items):
+        request_items={table_name: [{'PutRequest': {'Item': item}} for item in items]}
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                response=self.ddb_client.batch_write_item(RequestItems=request_items)
+                request_items=response.get('UnprocessedItems') or {}
+            except botocore.exceptions.ClientError as error:
+                self._retry(table_name, 'writeBatch', error, attempt)
+            if not request_items:
+                return
+            time.sleep(random.uniform(0, BASE_DELAY * (2 ** attempt)))
+        event_log.event('sink', 'unprocessedItems', ERROR, Table=table_name, Items=len(request_items.get(table_name, [])))
+        raise RuntimeError(str(len(request_items.get(table_name, []))) + ' items not written to ' + table_name)
+
+    def _writeUpdate(self, table_name, item_key, attributes, defaults):
+        names=sorted(attributes)
+        default_names=sorted(name for name in defaults if name not in attributes)
+        expressions=['#a' + str(i) + ' = :v' + str(i) for i in range(len(names))]
+        expressions += ['#d' + str(i) + ' = if_not_exists(#d' + str(i) + ', :d' + str(i) + ')' for i in range(len(default_names))]
+        expression_names={'#a' + str(i): name for i, name in enumerate(names)}
+        expression_names.update({'#d' + str(i): name for i, name in enumerate(default_names)})
+        expression_values={':v' + str(i): attributes[name] for i, name in enumerate(names)}
+        expression_values.update({':d' + str(i): defaults[name] for i, name in enumerate(default_names)})
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                self.ddb_client.update_item(
+                    TableName=table_name,
+                    Key={name: {'S': value} for name, value in zip(self.table_keys[table_name], item_key)},
+                    UpdateExpression='SET ' + ', '.join(expressions),
+                    ExpressionAttributeNames=expression_names,
+                    ExpressionAttributeValues=expression_values
+                )
+                return
+            except botocore.exceptions.ClientError as error:
+                self._retry(table_name, 'update', error, attempt)
+            time.sleep(random.uniform(0, BASE_DELAY * (2 ** attempt)))
@@ -0,0 +1,110 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+'''
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+DEBUG=10
+INFO=20
+WARNING=30
+ERROR=40
+LEVELS={'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+LEVEL_NAMES={level: name for name, level in LEVELS.items()}
+
+# Lowest level written, for all stages and per stage, e.g. 'crawl=DEBUG,accept=WARNING'
+LOG_LEVEL=LEVELS[os.environ.get('LOG_LEVEL', 'INFO').upper()]
+LOG_STAGE_LEVELS={stage.strip(): LEVELS[level.strip().upper()] for stage, level in
+    (pair.split('=') for pair in os.environ.get('LOG_STAGE_LEVELS', '').split(',') if pair.strip())}
+# Share of the sampled events, the per OU and per account events, that is written
+LOG_SAMPLE_RATE=float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+# Buffered lines, and account summary records, are written together once
+# there are this many
+LOG_BUFFER_LINES=int(os.environ.get('LOG_BUFFER_LINES', '500'))
+# Seconds before the function timeout at which everything buffered is written
+LOG_FLUSH_MARGIN=float(os.environ.get('LOG_FLUSH_MARGIN', '2'))
+
+class EventLog(object):
+    """
+    Structured log of JSON lines. Events below the level of their stage are
+    dropped, sampled events are kept with the probability LOG_SAMPLE_RATE,
+    and the lines are buffered and written with a single write. Every
+    account touched gets a summary record, whatever the levels and the
+    sampling. At most LOG_BUFFER_LINES summaries are held, an account
+    updated again after they were written gets a new record
+    """
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.function=None
+        self.lines=[]
+        # Account id to its summary record
+        self.accounts={}
+        # Name to the number of events kept and dropped
+        self.counts={}
+
+    def reset(self, function):
+        with self.lock:
+            self.function=function
+            self.lines=[]
+            self.accounts={}
+            self.counts={}
+
+    def enabled(self, stage, level):
+        return level >= LOG_STAGE_LEVELS.get(stage, LOG_LEVEL)
+
+    def event(self, stage, name, level=INFO, sampled=False, **fields):
+        """
+        Records the event name of stage with the given fields. ERROR events
+        are written at once
+        """
+        keep=self.enabled(stage, level) and (not sampled or random.random() < LOG_SAMPLE_RATE)
+        with self.lock:
+            counts=self.counts.setdefault(name, [0, 0])
+            counts[0 if keep else 1] += 1
+            if not keep:
+                return
+            record={'Time': round(time.time(), 3), 'Level': LEVEL_NAMES.get(level, level), 'Function': self.function, 'Stage': stage, 'Event': name}
+            record.update(fields)
+            self.lines.append(json.dumps(record, separators=(',', ':'), default=str))
+            full=len(self.lines) >= LOG_BUFFER_LINES
+        if full or level >= ERROR:
+            self.flush(summaries=False)
+
+    def account(self, account_id, **fields):
+        """
+        Merges the fields into the summary record of the account
+        """
+        with self.lock:
+            self.accounts.setdefault(account_id, {'Account': account_id}).update(fields)
+            full=len(self.accounts) >= LOG_BUFFER_LINES
+        if full:
+            self.flush(summaries=True, counts=False)
+
+    def flush(self, summaries=True, counts=True):
+        """
+        Writes the buffered lines, with summaries the account summary
+        records, and with summaries and counts the number of events kept and
+        dropped
+        """
+        with self.lock:
+            lines=self.lines
+            self.lines=[]
+            if summaries:
+                for record in self.accounts.values():
+                    lines.append(json.dumps(dict(record, Function=self.function, Event='accountSummary'), separators=(',', ':'), default=str))
+                self.accounts={}
+            if summaries and counts:
+                if self.counts:
+                    lines.append(json.dumps({'Function': self.function, 'Event': 'logSummary', 'Events': {name: {'Kept': kept, 'Dropped': dropped} for name, (kept, dropped) in self.counts.items()}}, separators=(',', ':')))
+                self.counts={}
+            if lines:
+                sys.stdout.write('\n'.join(lines) + '\n')
+                sys.stdout.flush()
+
+# Shared by the functions and the layer
+event_log=EventLog()
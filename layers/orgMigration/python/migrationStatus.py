@@ -0,0 +1,127 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+'''
+
+import botocore
+import time
+from eventLog import WARNING, event_log
+from ddbReader import queryTable
+
+# Progress of an account through the migration, kept in the MigrationStatus
+# attribute of the account table. Every stage only does the steps that come
+# after the recorded status, so a rerun only works on the remaining accounts
+PENDING='PENDING'
+INVITED='INVITED'
+LEFT='LEFT'
+ACCEPTED='ACCEPTED'
+MOVED='MOVED'
+STATUSES=[PENDING, INVITED, LEFT, ACCEPTED, MOVED]
+
+# Global secondary index of the account table keyed on MigrationStatus and
+# sharded by the old parent OU in AccountParentId
+STATUS_INDEX='MigrationStatusIndex'
+
+def statusOf(item):
+    """
+    Returns the status of an account item read from DynamoDB, items written
+    before the status was tracked are PENDING
+    """
+    return item.get('MigrationStatus', {}).get('S', PENDING)
+
+def hasReached(current, status):
+    """
+    True if an account in the current status is done with status
+    """
+    return STATUSES.index(current) >= STATUSES.index(status)
+
+def accountsInStatus(ddb_client, table_name, statuses, parent_id=None):
+    """
+    Queries the status index and yields the accounts in any of the given
+    statuses, only the accounts under the OU parent_id if it is given
+    """
+    for status in statuses:
+        condition='MigrationStatus = :status'
+        values={':status': {'S': status}}
+        if parent_id:
+            condition += ' AND AccountParentId = :parent'
+            values[':parent']={'S': parent_id}
+        for item in queryTable(ddb_client, table_name, IndexName=STATUS_INDEX, KeyConditionExpression=condition, ExpressionAttributeValues=values):
+            yield item
+
+def setStatus(ddb_client, table_name, account_id, status, attributes=None, previous=None):
+    """
+    Advances the account to status with a conditional write that only
+    succeeds when the account is in the previous status, by default the one
+    right before status, so repeated or concurrent runs cannot record a step
+    twice. Extra attributes (name to AttributeValue) are set in the same
+    write. Returns False when the account was not in the expected status
+    """
+    if previous is None:
+        previous=STATUSES[STATUSES.index(status) - 1]
+    names={'#status': 'MigrationStatus'}
+    values={':status': {'S': status}, ':previous': {'S': previous}}
+    assignments=['#status = :status']
+    for i, (name, value) in enumerate(sorted((attributes or {}).items())):
+        names['#a' + str(i)]=name
+        values[':v' + str(i)]=value
+        assignments.append('#a' + str(i) + ' = :v' + str(i))
+
+    condition='#status = :previous'
+    if previous == PENDING:
+        condition += ' OR attribute_not_exists(#status)'
+
+    try:
+        ddb_client.update_item(
+            TableName=table_name,
+            Key={'AccountId': {'S': account_id}},
+            UpdateExpression='SET ' + ', '.join(assignments),
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            event_log.event('status', 'statusSkipped', WARNING, Account=account_id, Status=status, Expected=previous)
+            return False
+        raise
+    return True
+
+def isClaimed(item, now):
+    """
+    True if another invocation holds an unexpired claim on the account item
+    """
+    return float(item.get('ClaimedUntil', {}).get('N', '0')) > now
+
+def claimAccount(ddb_client, table_name, account_id, lease_seconds):
+    """
+    Claims the account for lease_seconds with a conditional write, so the
+    invocations started by the account table stream and by the state
+    machine do not migrate the same account at the same time. Returns
+    False if another invocation holds the claim
+    """
+    now=time.time()
+    try:
+        ddb_client.update_item(
+            TableName=table_name,
+            Key={'AccountId': {'S': account_id}},
+            UpdateExpression='SET ClaimedUntil = :until',
+            ConditionExpression='attribute_not_exists(ClaimedUntil) OR ClaimedUntil < :now',
+            ExpressionAttributeValues={':until': {'N': str(int(now + lease_seconds))}, ':now': {'N': str(int(now))}}
+        )
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            event_log.event('status', 'accountClaimed', Account=account_id)
+            return False
+        raise
+    return True
+
+def releaseAccount(ddb_client, table_name, account_id):
+    """
+    Releases the claim on the account once the invocation is done with it
+    """
+    ddb_client.update_item(
+        TableName=table_name,
+        Key={'AccountId': {'S': account_id}},
+        UpdateExpression='REMOVE ClaimedUntil'
+    )
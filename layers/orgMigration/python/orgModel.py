@@ -0,0 +1,187 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+'''
+
+import sys
+import threading
+from array import array
+from eventLog import WARNING, event_log
+
+ROOT='ROOT'
+ORGANIZATIONAL_UNIT='ORGANIZATIONAL_UNIT'
+
+class OuNode(object):
+    """
+    The root or an OU. Nodes refer to their parent and children by their
+    index in OrgTree.ous, -1 is the parent of the root
+    """
+    __slots__=('index', 'id', 'name', 'type', 'parent', 'children', 'accounts', 'new_id')
+
+    def __init__(self, index, ou_id, name, ou_type, parent):
+        self.index=index
+        self.id=ou_id
+        self.name=name
+        self.type=ou_type
+        self.parent=parent
+        self.children=array('i')
+        self.accounts=array('i')
+        self.new_id=None
+
+class AccountNode(object):
+    __slots__=('index', 'id', 'name', 'email', 'status', 'parent')
+
+    def __init__(self, index, account_id, name, email, status, parent):
+        self.index=index
+        self.id=account_id
+        self.name=name
+        self.email=email
+        self.status=status
+        self.parent=parent
+
+class OrgTree(object):
+    """
+    Compact in-memory model of an organization. Ids are interned and the
+    nodes are linked by index, so large organizations stay small in memory
+    and tree queries need no API or DynamoDB calls. Adding nodes is
+    thread-safe, a parent has to be added before its children
+    """
+    def __init__(self):
+        self.ous=[]
+        self.accounts=[]
+        self.ou_index={}
+        self.account_index={}
+        # Materialized paths already resolved, keyed by OU index. Nodes are
+        # never moved, so a path does not change once it is known
+        self.paths={}
+        self.lock=threading.Lock()
+
+    def addOu(self, ou_id, name, parent_id=None, ou_type=ORGANIZATIONAL_UNIT):
+        """
+        Adds the root (without parent_id) or an OU under parent_id
+        """
+        ou_id=sys.intern(ou_id)
+        with self.lock:
+            if ou_id in self.ou_index:
+                return self.ous[self.ou_index[ou_id]]
+            parent=-1 if parent_id is None else self.ou_index[parent_id]
+            node=OuNode(len(self.ous), ou_id, name, ROOT if parent_id is None else ou_type, parent)
+            self.ous.append(node)
+            self.ou_index[ou_id]=node.index
+            if parent >= 0:
+                self.ous[parent].children.append(node.index)
+            return node
+
+    def addAccount(self, account_id, name, email, status, parent_id):
+        """
+        Adds an account under parent_id, an account that is already in the
+        tree is returned as it is
+        """
+        account_id=sys.intern(account_id)
+        with self.lock:
+            if account_id in self.account_index:
+                return self.accounts[self.account_index[account_id]]
+            parent=self.ou_index[parent_id]
+            node=AccountNode(len(self.accounts), account_id, name, email, status, parent)
+            self.accounts.append(node)
+            self.account_index[account_id]=node.index
+            self.ous[parent].accounts.append(node.index)
+            return node
+
+    def ou(self, ou_id):
+        return self.ous[self.ou_index[ou_id]]
+
+    def account(self, account_id):
+        return self.accounts[self.account_index[account_id]]
+
+    def roots(self):
+        return [node for node in self.ous if node.parent < 0]
+
+    def children(self, ou_id):
+        return [self.ous[index] for index in self.ou(ou_id).children]
+
+    def ancestors(self, ou_id):
+        """
+        Returns the ancestors of an OU, from its parent up to the root
+        """
+        nodes=[]
+        index=self.ou(ou_id).parent
+        while index >= 0:
+            nodes.append(self.ous[index])
+            index=self.ous[index].parent
+        return nodes
+
+    def path(self, ou_id):
+        """
+        Materialized path of the OU, the ids from the root to the OU. Paths
+        are memoized, so resolving the path of an OU whose parent was
+        resolved before is a single lookup
+        """
+        node=self.ou(ou_id)
+        unresolved=[]
+        while node.index not in self.paths:
+            unresolved.append(node)
+            if node.parent < 0:
+                break
+            node=self.ous[node.parent]
+        for node in reversed(unresolved):
+            if node.parent < 0:
+                self.paths[node.index]=node.id
+            else:
+                self.paths[node.index]=self.paths[node.parent] + '/' + node.id
+        return self.paths[self.ou_index[ou_id]]
+
+    def subtree(self, ou_id):
+        """
+        Yields the OU and every OU below it, parents before children
+        """
+        stack=[self.ou_index[ou_id]]
+        while stack:
+            node=self.ous[stack.pop()]
+            yield node
+            stack.extend(reversed(node.children))
+
+    def levels(self):
+        """
+        Returns the OUs grouped by depth, the OUs directly under the roots
+        first. The OUs of one level do not depend on each other
+        """
+        levels=[]
+        level=[child for root in self.roots() for child in root.children]
+        while level:
+            nodes=[self.ous[index] for index in level]
+            levels.append(nodes)
+            level=[child for node in nodes for child in node.children]
+        return levels
+
+    @classmethod
+    def fromOuItems(cls, items):
+        """
+        Builds the tree from the items of the OU table. The roots are not
+        stored in the table, they are created from the OuParentId of the OUs
+        directly under them
+        """
+        tree=cls()
+        pending=[]
+        for item in items:
+            if item['OuParentType']['S'] == ROOT:
+                tree.addOu(item['OuParentId']['S'], item.get('OuParentName', {}).get('S', 'Root'))
+            pending.append(item)
+
+        # Sorting by the depth of OuPath adds the parents first, so a single
+        # pass is enough. Otherwise the passes repeat until nothing changes
+        pending.sort(key=lambda item: item.get('OuPath', {}).get('S', '').count('/'))
+        while pending:
+            remaining=[]
+            for item in pending:
+                if item['OuParentId']['S'] in tree.ou_index:
+                    node=tree.addOu(item['OuId']['S'], item['OuName']['S'], item['OuParentId']['S'])
+                    if 'NewOuId' in item:
+                        node.new_id=item['NewOuId']['S']
+                else:
+                    remaining.append(item)
+            if len(remaining) == len(pending):
+                event_log.event('model', 'orphanOus', WARNING, Ous=len(remaining))
+                break
+            pending=remaining
+        return tree
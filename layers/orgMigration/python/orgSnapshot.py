@@ -0,0 +1,145 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+'''
+
+import botocore
+import gzip
+import json
+import os
+import time
+from eventLog import event_log
+from orgModel import OrgTree
+
+# Versioned bucket and key of the snapshot, every write is a new object version
+SNAPSHOT_BUCKET=os.environ.get('SNAPSHOT_BUCKET')
+SNAPSHOT_KEY=os.environ.get('SNAPSHOT_KEY', 'orgSnapshot.jsonl.gz')
+# Key of the partial tree and frontier a scan leaves for its next invocation
+CHECKPOINT_KEY=os.environ.get('CHECKPOINT_KEY', 'orgScanCheckpoint.jsonl.gz')
+# Version of the snapshot format, written in the header line
+SNAPSHOT_FORMAT=1
+
+def dumpTree(tree, header=None):
+    """
+    Serializes an OrgTree to gzip'd JSON lines: a header line, then the
+    roots and OUs with every parent before its children, then the accounts.
+    The fields of header are added to the header line
+    """
+    lines=[{'Format': SNAPSHOT_FORMAT, 'CreatedAt': int(time.time()), 'Ous': len(tree.ous), 'Accounts': len(tree.accounts)}]
+    lines[0].update(header or {})
+    for ou in tree.ous:
+        line={'Ou': ou.id, 'Name': ou.name, 'Type': ou.type}
+        if ou.parent >= 0:
+            line['Parent']=tree.ous[ou.parent].id
+        if ou.new_id:
+            line['NewId']=ou.new_id
+        lines.append(line)
+    for account in tree.accounts:
+        lines.append({'Account': account.id, 'Name': account.name, 'Email': account.email, 'Status': account.status, 'Parent': tree.ous[account.parent].id})
+    body='\n'.join(json.dumps(line, separators=(',', ':')) for line in lines)
+    return gzip.compress(body.encode('utf-8'))
+
+def loadTree(data):
+    """
+    Rebuilds the OrgTree from a snapshot written by dumpTree
+    """
+    return loadTreeWithHeader(data)[0]
+
+def loadTreeWithHeader(data):
+    """
+    Rebuilds the OrgTree from a snapshot written by dumpTree and returns it
+    together with the header line
+    """
+    lines=gzip.decompress(data).decode('utf-8').split('\n')
+    header=json.loads(lines[0])
+    if header.get('Format') != SNAPSHOT_FORMAT:
+        raise ValueError('Unsupported snapshot format ' + str(header.get('Format')))
+
+    tree=OrgTree()
+    for line in lines[1:]:
+        record=json.loads(line)
+        if 'Ou' in record:
+            node=tree.addOu(record['Ou'], record['Name'], record.get('Parent'), record['Type'])
+            node.new_id=record.get('NewId')
+        else:
+            tree.addAccount(record['Account'], record['Name'], record['Email'], record['Status'], record['Parent'])
+    return tree, header
+
+def writeSnapshot(s3_client, tree):
+    """
+    Writes the tree to the snapshot bucket and returns the version id of
+    the new object, None if no bucket is configured or the write failed
+    """
+    if not SNAPSHOT_BUCKET:
+        return None
+    try:
+        response=s3_client.put_object(
+            Bucket=SNAPSHOT_BUCKET,
+            Key=SNAPSHOT_KEY,
+            Body=dumpTree(tree),
+            ContentType='application/gzip')
+        event_log.event('snapshot', 'snapshotWritten', Key=SNAPSHOT_KEY, Ous=len(tree.ous), Accounts=len(tree.accounts))
+        return response.get('VersionId')
+    except botocore.exceptions.ClientError as error:
+        print ('Caught exception writing snapshot')
+        print(error)
+        return None
+
+def readSnapshot(s3_client, version_id=None):
+    """
+    Loads the latest snapshot, or the given version of it, with a single
+    GET. Returns None if there is no snapshot, the callers then read the
+    Amazon DynamoDB tables instead
+    """
+    if not SNAPSHOT_BUCKET:
+        return None
+    args={'Bucket': SNAPSHOT_BUCKET, 'Key': SNAPSHOT_KEY}
+    if version_id:
+        args['VersionId']=version_id
+    try:
+        response=s3_client.get_object(**args)
+        return loadTree(response['Body'].read())
+    except botocore.exceptions.ClientError as error:
+        print ('Caught exception reading snapshot')
+        print(error)
+        return None
+
+def writeCheckpoint(s3_client, tree, state):
+    """
+    Writes the partial tree of an unfinished scan together with state, the
+    JSON serializable frontier of the scan, and returns the version id of
+    the checkpoint. Returns None if no bucket is configured or the write
+    failed, the scan then has to finish in the current invocation
+    """
+    if not SNAPSHOT_BUCKET:
+        return None
+    try:
+        response=s3_client.put_object(
+            Bucket=SNAPSHOT_BUCKET,
+            Key=CHECKPOINT_KEY,
+            Body=dumpTree(tree, {'Checkpoint': state}),
+            ContentType='application/gzip')
+        event_log.event('snapshot', 'checkpointWritten', Key=CHECKPOINT_KEY, Ous=len(tree.ous), Accounts=len(tree.accounts))
+        # An object in a bucket without versioning has the version id null
+        return response.get('VersionId', 'null')
+    except botocore.exceptions.ClientError as error:
+        print ('Caught exception writing checkpoint')
+        print(error)
+        return None
+
+def readCheckpoint(s3_client, version_id):
+    """
+    Loads the checkpoint version written by writeCheckpoint and returns the
+    partial tree and the state of the scan, or None, None if it can not be
+    read
+    """
+    if not SNAPSHOT_BUCKET:
+        return None, None
+    try:
+        response=s3_client.get_object(Bucket=SNAPSHOT_BUCKET, Key=CHECKPOINT_KEY, VersionId=version_id)
+        tree, header=loadTreeWithHeader(response['Body'].read())
+        return tree, header['Checkpoint']
+    except botocore.exceptions.ClientError as error:
+        print ('Caught exception reading checkpoint')
+        print(error)
+        return None, None
@@ -0,0 +1,194 @@
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: Apache-2.0
+'''
+
+import botocore
+import os
+import random
+import threading
+import time
+from eventLog import DEBUG, WARNING, event_log
+
+# AWS Organizations throttles API requests per account, the defaults keep a
+# single function comfortably below that limit
+ORG_API_RATE=float(os.environ.get('ORG_API_RATE', '10'))
+ORG_API_BURST=float(os.environ.get('ORG_API_BURST', '10'))
+# Bounds of the rate of an AdaptiveLimiter. The rate grows by about
+# ORG_API_RATE_STEP requests per second every second without throttling
+# and is halved on every throttled request
+ORG_API_MIN_RATE=float(os.environ.get('ORG_API_MIN_RATE', '1'))
+ORG_API_MAX_RATE=float(os.environ.get('ORG_API_MAX_RATE', '20'))
+ORG_API_RATE_STEP=float(os.environ.get('ORG_API_RATE_STEP', '1'))
+# Throttled calls are retried with full jitter exponential backoff, in place
+# of the retries of botocore. A call gives up once its retries would take
+# more than ORG_RETRY_SECONDS, well below the timeout of the functions
+ORG_MAX_ATTEMPTS=int(os.environ.get('ORG_MAX_ATTEMPTS', '8'))
+ORG_BACKOFF_BASE=float(os.environ.get('ORG_BACKOFF_BASE', '0.5'))
+ORG_BACKOFF_MAX=float(os.environ.get('ORG_BACKOFF_MAX', '5'))
+ORG_RETRY_SECONDS=float(os.environ.get('ORG_RETRY_SECONDS', '10'))
+# Calls to AWS Organizations in flight in the whole process, and per
+# operation, e.g. 'CreateOrganizationalUnit=2,MoveAccount=4'
+ORG_API_CONCURRENCY=int(os.environ.get('ORG_API_CONCURRENCY', '16'))
+ORG_OPERATION_CONCURRENCY=os.environ.get('ORG_OPERATION_CONCURRENCY', '')
+
+# Error codes of requests rejected because of the request rate, and of
+# requests that conflict with a concurrent change or hit a transient error
+# of the service. They succeed when they are sent again later, only the
+# first lower the rate
+THROTTLE_CODES=['TooManyRequestsException', 'ThrottlingException', 'Throttling']
+RETRY_CODES=THROTTLE_CODES + ['ConcurrentModificationException', 'ServiceException']
+
+# Shared by every AdaptiveLimiter of the process
+_budget=threading.BoundedSemaphore(ORG_API_CONCURRENCY)
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket. One bucket is shared by every worker that
+    calls the same API so that the workers together stay within the rate
+    """
+    # Retry configuration of botocore for the clients it is attached to,
+    # None keeps the default
+    retries=None
+
+    def __init__(self, rate=ORG_API_RATE, burst=ORG_API_BURST):
+        self.rate=float(rate)
+        self.capacity=float(burst)
+        self.tokens=self.capacity
+        self.updated=time.monotonic()
+        self.lock=threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        """
+        while True:
+            with self.lock:
+                now=time.monotonic()
+                self.tokens=min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated=now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay=(1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def attach(self, client):
+        """
+        Takes a token before every request sent by the boto3 client,
+        including the requests made by its paginators
+        """
+        client.meta.events.register('before-call', self._beforeCall)
+        return client
+
+    def _beforeCall(self, **kwargs):
+        self.acquire()
+
+def errorCode(error):
+    return error.response.get('Error', {}).get('Code')
+
+def backoff(attempt):
+    """
+    Full jitter exponential backoff, the delay before the given retry
+    """
+    return random.uniform(0, min(ORG_BACKOFF_MAX, ORG_BACKOFF_BASE * 2 ** attempt))
+
+class AdaptiveLimiter(TokenBucket):
+    """
+    Token bucket whose rate adapts to the throttling of the API: it grows
+    additively while the requests succeed and is halved multiplicatively
+    when a request is throttled. Attached clients also retry throttled calls
+    with backoff and respect the per operation and process-wide caps on the
+    calls in flight, so parallel workers run as fast as the API allows.
+    The retries stop at deadline, the time.time() a function has to be done
+    by, if one is set
+    """
+    # botocore sends every request once, the retries and their sleeps are
+    # done by call() outside the concurrency caps
+    retries={'mode': 'standard', 'max_attempts': 1}
+
+    def __init__(self, rate=ORG_API_RATE, burst=ORG_API_BURST, min_rate=ORG_API_MIN_RATE, max_rate=ORG_API_MAX_RATE, operation_concurrency=ORG_OPERATION_CONCURRENCY):
+        TokenBucket.__init__(self, rate, burst)
+        self.min_rate=float(min_rate)
+        self.max_rate=float(max_rate)
+        self.deadline=None
+        self.operations={}
+        for cap in operation_concurrency.split(','):
+            if '=' in cap:
+                operation, limit=cap.split('=')
+                self.operations[operation.strip()]=threading.BoundedSemaphore(int(limit))
+
+    def acquire(self):
+        """
+        Takes a token, once the deadline has passed requests are sent without
+        waiting so the function can still finish in time
+        """
+        if self.deadline is not None and time.time() >= self.deadline:
+            return
+        TokenBucket.acquire(self)
+
+    def increase(self):
+        with self.lock:
+            self.rate=min(self.max_rate, self.rate + ORG_API_RATE_STEP / self.rate)
+
+    def decrease(self):
+        with self.lock:
+            self.rate=max(self.min_rate, self.rate / 2)
+            self.tokens=min(self.tokens, 0)
+            event_log.event('throttle', 'rateLowered', WARNING, sampled=True, Rate=round(self.rate, 2))
+
+    def attach(self, client):
+        """
+        Lowers the rate when a request sent by the boto3 client is throttled
+        and wraps the calls of the client, including the calls made by its
+        paginators, with the token bucket, the concurrency caps and the
+        retries
+        """
+        client.meta.events.register('needs-retry', self._needsRetry)
+        make_api_call=client._make_api_call
+        def call(operation_name, api_params):
+            return self.call(operation_name, lambda: make_api_call(operation_name, api_params))
+        client._make_api_call=call
+        return client
+
+    def call(self, operation_name, send):
+        """
+        Sends one API call within the caps and retries it while it is
+        throttled or conflicts with a concurrent change, up to
+        ORG_MAX_ATTEMPTS times and ORG_RETRY_SECONDS. Every attempt is a
+        single request that takes a token first, then the cap of its
+        operation and then a slot of the process, so no slot is held while
+        waiting for the rate or the operation, nor during the backoff. The
+        rate is lowered by _needsRetry, which sees every throttled attempt
+        """
+        operation=self.operations.get(operation_name)
+        give_up=time.time() + ORG_RETRY_SECONDS
+        if self.deadline is not None:
+            give_up=min(give_up, self.deadline)
+        attempt=0
+        while True:
+            try:
+                self.acquire()
+                if operation:
+                    operation.acquire()
+                try:
+                    with _budget:
+                        result=send()
+                finally:
+                    if operation:
+                        operation.release()
+            except botocore.exceptions.ClientError as error:
+                attempt += 1
+                delay=backoff(attempt)
+                if errorCode(error) not in RETRY_CODES or attempt >= ORG_MAX_ATTEMPTS or time.time() + delay > give_up:
+                    raise
+                event_log.event('throttle', 'retry', DEBUG, sampled=True, Operation=operation_name, Error=errorCode(error), Attempt=attempt)
+                time.sleep(delay)
+                continue
+            self.increase()
+            return result
+
+    def _needsRetry(self, response=None, **kwargs):
+        # Only observes the attempts, botocore decides about its own retries
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            self.decrease()
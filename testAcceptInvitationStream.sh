@@ -0,0 +1 @@
+sam local invoke acceptInvitation --env-vars tests/testAll.json --event tests/acceptInvitationStream.json
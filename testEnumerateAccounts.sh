@@ -0,0 +1 @@
+sam local invoke enumerateAccounts --env-vars tests/testAll.json
\ No newline at end of file